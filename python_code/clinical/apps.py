@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ClinicalConfig(AppConfig):
     name = 'clinical'
+
+    def ready(self):
+        # Connect the receivers invalidating the per-process ontology caches
+        from . import ontology_utils  # noqa: F401
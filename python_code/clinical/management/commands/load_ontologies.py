@@ -0,0 +1,262 @@
+"""Load the ICD-O-3 morphologies/topographies and the ICD-10 diagnoses from the archived source files.
+
+The files are read straight out of the zips in archives/synonyms:
+ - ICD-O-3_CSV-metadata.zip: Morphenglish.txt and Topoenglish.txt (tab separated),
+ - ICD-10-CSV-master.zip: categories.csv and codes.csv.
+
+The whole ontology is built in memory, compared to what is already in the database, and only the missing rows are
+bulk inserted, so the command can be run again safely. The closure table of the diagnosis hierarchy is then updated.
+"""
+import csv
+import io
+import os
+import zipfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clinical.models import (
+    SYNONYM_MODELS,
+    Diagnosis,
+    Morphology,
+    Topography,
+    rebuild_diagnosis_closure,
+    rebuild_labels
+)
+from clinical.signals import synonyms_changed
+
+ICDO3_ARCHIVE = 'ICD-O-3_CSV-metadata.zip'
+ICD10_ARCHIVE = 'ICD-10-CSV-master.zip'
+
+# Types of the synonyms (see MorphologySynonym, TopographySynonym and DiagnosisSynonym)
+ICDO3_CODE, ICDO3_NAME, ICDO3_SYNONYM = 'icdo_code', 'icdo_name', 'icdo_synonym'
+ICD10_CODE, ICD10_NAME = 'icd10_code', 'icd10_name'
+
+
+class OntologyEntry:
+    """One code of an ontology, with its synonyms (type, description) and the code of its parent."""
+
+    def __init__(self, code, code_type, parent_code=None):
+        self.code = code
+        self.parent_code = parent_code
+        self.synonyms = [(code_type, code)]
+
+    def add_synonym(self, synonym_type, description):
+        description = description.strip()
+        if description and (synonym_type, description) not in self.synonyms:
+            self.synonyms.append((synonym_type, description))
+
+    def first_synonyms(self):
+        """Same structure as clinical.models.first_synonyms, to compute the materialized labels."""
+        result = {}
+        for synonym_type, description in self.synonyms:
+            result.setdefault(synonym_type, description)
+        return result
+
+
+def _open_text(archive, member):
+    """Stream a member of a zip archive as text."""
+    return io.TextIOWrapper(archive.open(member), encoding='latin-1', newline='')
+
+
+def _find_member(archive, name):
+    return next(member for member in archive.namelist() if member.rsplit('/', 1)[-1] == name)
+
+
+def read_icdo3_morphologies(archive):
+    """Read Morphenglish.txt: Code, Struct (title or sub) and Label columns."""
+    entries = {}
+    reader = csv.reader(_open_text(archive, _find_member(archive, 'Morphenglish.txt')), delimiter='\t')
+    next(reader)
+    for row in reader:
+        if len(row) < 3 or not row[0].strip():
+            continue
+        # A few codes are quoted over two lines in the source file
+        code = row[0].split()[-1].strip('"')
+        entry = entries.setdefault(code, OntologyEntry(code, ICDO3_CODE))
+        entry.add_synonym(ICDO3_NAME if row[1] == 'title' else ICDO3_SYNONYM, row[2])
+    return entries
+
+
+def read_icdo3_topographies(archive):
+    """Read Topoenglish.txt: Kode, Lvl (3, 4 or incl for included terms) and Title columns."""
+    entries = {}
+    reader = csv.reader(_open_text(archive, _find_member(archive, 'Topoenglish.txt')), delimiter='\t')
+    next(reader)
+    for row in reader:
+        if len(row) < 3 or row[1] not in ('3', '4', 'incl'):
+            # b and k rows are the bullets and headings of the printed version
+            continue
+        code = row[0].strip()
+        entry = entries.setdefault(code, OntologyEntry(code, ICDO3_CODE))
+        entry.add_synonym(ICDO3_NAME if row[1] in ('3', '4') else ICDO3_SYNONYM, row[2])
+    return entries
+
+
+def format_icd10_code(code):
+    """C8100 -> C81.00"""
+    return code if len(code) <= 3 else code[:3] + '.' + code[3:]
+
+
+def read_icd10_diagnoses(archive):
+    """Read categories.csv and codes.csv, the parent of a code being its longest known prefix."""
+    raw_entries = {}
+
+    reader = csv.reader(_open_text(archive, _find_member(archive, 'categories.csv')), skipinitialspace=True)
+    next(reader)
+    for row in reader:
+        if len(row) == 2:
+            raw_entries.setdefault(row[0], OntologyEntry(row[0], ICD10_CODE)).add_synonym(ICD10_NAME, row[1])
+
+    reader = csv.reader(_open_text(archive, _find_member(archive, 'codes.csv')), skipinitialspace=True)
+    next(reader)
+    for row in reader:
+        if len(row) != 6:
+            # A handful of rows are broken in the source file
+            continue
+        raw_entries.setdefault(row[2], OntologyEntry(row[2], ICD10_CODE)).add_synonym(ICD10_NAME, row[4])
+
+    entries = {}
+    for raw_code, raw_entry in raw_entries.items():
+        parent = next((raw_code[:length] for length in range(len(raw_code) - 1, 2, -1) if raw_code[:length] in raw_entries),
+                      None)
+        entry = OntologyEntry(format_icd10_code(raw_code), ICD10_CODE, format_icd10_code(parent) if parent else None)
+        entry.synonyms.extend(raw_entry.synonyms[1:])
+        entries[entry.code] = entry
+    return entries
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class OntologyLoader:
+    """Insert the entries missing from the database for one ontology model."""
+
+    def __init__(self, model, code_type, batch_size, stdout):
+        self.model = model
+        self.synonym_model, self.parent_field = SYNONYM_MODELS[model]
+        # Type of the synonyms holding the codes
+        self.code_type = code_type
+        self.batch_size = batch_size
+        self.stdout = stdout
+
+    def existing_ids(self):
+        """Map the (case-folded) codes already in the database to their row id."""
+        codes = self.synonym_model.objects.filter(type=self.code_type).values_list('description', self.parent_field + '_id')
+        return {code.casefold(): row_id for code, row_id in codes}
+
+    def load(self, entries):
+        ids = self.existing_ids()
+        new_ids = self.create_rows([entry for entry in entries.values() if entry.code.casefold() not in ids], ids)
+        ids.update(new_ids)
+        self.update_parents(entries, ids, new_ids)
+        updated_ids = self.create_synonyms(entries, ids)
+
+        # The labels of the new rows were set on insert, the others are recomputed from their synonyms
+        updated_ids -= set(new_ids.values())
+        if updated_ids:
+            for chunk in _chunks(sorted(updated_ids), self.batch_size):
+                rebuild_labels(self.model, chunk)
+
+        self.stdout.write('{}: {} codes, {} created, {} updated'.format(
+            self.model.__name__, len(entries), len(new_ids), len(updated_ids)))
+        return bool(new_ids or updated_ids)
+
+    def create_rows(self, entries, ids):
+        """Bulk insert the new rows, parents before children, and return their ids by case-folded code."""
+        new_ids = {}
+        if not entries:
+            return new_ids
+
+        depths = {}
+
+        def depth(entry):
+            if entry.code not in depths:
+                parent = entries_by_code.get(entry.parent_code)
+                depths[entry.code] = 0 if parent is None else depth(parent) + 1
+            return depths[entry.code]
+
+        entries_by_code = {entry.code: entry for entry in entries}
+        levels = {}
+        for entry in entries:
+            levels.setdefault(depth(entry), []).append(entry)
+
+        for level in sorted(levels):
+            last_id = self.model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            rows = []
+            for entry in levels[level]:
+                row = self.model(**self.model.labels_from_synonyms(entry.first_synonyms()))
+                if entry.parent_code is not None:
+                    row.parent_id = new_ids.get(entry.parent_code.casefold(), ids.get(entry.parent_code.casefold()))
+                rows.append(row)
+            self.model.objects.bulk_create(rows, batch_size=self.batch_size)
+
+            # bulk_create does not return the ids on every database backend, the materialized codes are used instead
+            for code, row_id in self.model.objects.filter(id__gt=last_id).values_list('code', 'id'):
+                new_ids[code.casefold()] = row_id
+        return new_ids
+
+    def update_parents(self, entries, ids, new_ids):
+        if not any(entry.parent_code for entry in entries.values()):
+            return
+        created = set(new_ids.values())
+        current_parents = dict(self.model.objects.values_list('id', 'parent_id'))
+        for entry in entries.values():
+            row_id = ids[entry.code.casefold()]
+            parent_id = ids.get(entry.parent_code.casefold()) if entry.parent_code else None
+            if row_id not in created and current_parents.get(row_id) != parent_id:
+                self.model.objects.filter(id=row_id).update(parent_id=parent_id)
+
+    def create_synonyms(self, entries, ids):
+        """Bulk insert the missing synonyms, and return the ids of the rows which got new ones."""
+        existing = set(self.synonym_model.objects.values_list(self.parent_field + '_id', 'type', 'description'))
+        synonyms = []
+        updated_ids = set()
+        for entry in entries.values():
+            row_id = ids[entry.code.casefold()]
+            for synonym_type, description in entry.synonyms:
+                if (row_id, synonym_type, description) not in existing:
+                    synonyms.append(self.synonym_model(
+                        type=synonym_type, description=description, **{self.parent_field + '_id': row_id}))
+                    existing.add((row_id, synonym_type, description))
+                    updated_ids.add(row_id)
+        self.synonym_model.objects.bulk_create(synonyms, batch_size=self.batch_size)
+        return updated_ids
+
+
+class Command(BaseCommand):
+    help = 'Load the ICD-O-3 morphologies and topographies and the ICD-10 diagnoses from the archived source files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--archive-dir', default=os.path.join(settings.BASE_DIR, '..', 'archives', 'synonyms'),
+            help='Directory containing {} and {}'.format(ICDO3_ARCHIVE, ICD10_ARCHIVE)
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of rows per INSERT')
+
+    def handle(self, *args, **options):
+        archive_dir = options['archive_dir']
+        batch_size = options['batch_size']
+
+        with zipfile.ZipFile(os.path.join(archive_dir, ICDO3_ARCHIVE)) as archive:
+            morphologies = read_icdo3_morphologies(archive)
+            topographies = read_icdo3_topographies(archive)
+        with zipfile.ZipFile(os.path.join(archive_dir, ICD10_ARCHIVE)) as archive:
+            diagnoses = read_icd10_diagnoses(archive)
+
+        changed = []
+        with transaction.atomic():
+            for model, code_type, entries in ((Morphology, ICDO3_CODE, morphologies),
+                                              (Topography, ICDO3_CODE, topographies),
+                                              (Diagnosis, ICD10_CODE, diagnoses)):
+                if OntologyLoader(model, code_type, batch_size, self.stdout).load(entries):
+                    changed.append(model)
+
+            inserted, deleted = rebuild_diagnosis_closure(batch_size=batch_size)
+            self.stdout.write('Diagnosis hierarchy: {} closure rows inserted, {} deleted'.format(inserted, deleted))
+
+        for model in changed:
+            synonyms_changed.send(sender=model, ids=None)
@@ -0,0 +1,15 @@
+"""Recompute the materialized codes and labels of the ontology models from their synonyms."""
+from django.core.management.base import BaseCommand
+
+from clinical.models import SYNONYM_MODELS, rebuild_labels
+from clinical.signals import synonyms_changed
+
+
+class Command(BaseCommand):
+    help = 'Recompute the code/label columns of Morphology, Topography, Diagnosis and Drug from their synonyms.'
+
+    def handle(self, *args, **options):
+        for model in SYNONYM_MODELS:
+            computed = rebuild_labels(model)
+            synonyms_changed.send(sender=model, ids=None)
+            self.stdout.write('{}: {} labels rebuilt'.format(model.__name__, len(computed)))
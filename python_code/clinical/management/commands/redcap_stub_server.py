@@ -0,0 +1,107 @@
+"""Local stand-in for the REDCap API, to test the REDCap caching and mirroring without the real server.
+
+The data is read from a JSON file of the form:
+
+    {"<api token>": {"metadata": [{"field_name": ..., ...}, ...],
+                     "records": [{"record_id": ..., "redcap_event_name": ..., ...}, ...]}}
+
+A record may have a "_last_modified" value ("YYYY-MM-DD HH:MM:SS"), used for the dateRangeBegin filter and not
+exported. Point the REDCap API URL used by the aauh helpers at http://localhost:<port>/api/.
+"""
+import csv
+import io
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from django.core.management.base import BaseCommand
+
+LAST_MODIFIED = '_last_modified'
+
+
+def _list_param(params, name):
+    """REDCap accepts lists as name[0]=a&name[1]=b or as a comma separated name=a,b."""
+    values = []
+    for key, key_values in sorted(params.items()):
+        if key == name or key.startswith(name + '['):
+            for value in key_values:
+                values.extend(item.strip() for item in value.split(',') if item.strip())
+    return values
+
+
+def export(project, params):
+    """Answer an export request of the REDCap API from the data of a project."""
+    content = params.get('content', ['record'])[0]
+    if content == 'metadata':
+        return project.get('metadata', [])
+    if content != 'record':
+        raise ValueError('Unsupported content: {}'.format(content))
+
+    records = project.get('records', [])
+    record_ids = set(_list_param(params, 'records'))
+    if record_ids:
+        records = [record for record in records if str(record.get('record_id')) in record_ids]
+    events = set(_list_param(params, 'events'))
+    if events:
+        records = [record for record in records if record.get('redcap_event_name') in events]
+    date_range_begin = params.get('dateRangeBegin', [''])[0]
+    if date_range_begin:
+        records = [record for record in records if record.get(LAST_MODIFIED, '') >= date_range_begin]
+    return [{key: value for key, value in record.items() if key != LAST_MODIFIED} for record in records]
+
+
+class RedcapStubHandler(BaseHTTPRequestHandler):
+    projects = {}
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True)
+        project = self.projects.get(params.get('token', [''])[0])
+        if project is None:
+            self._send(403, 'application/json', json.dumps({'error': 'You do not have permissions to use the API'}))
+            return
+        try:
+            rows = export(project, params)
+        except ValueError as e:
+            self._send(400, 'application/json', json.dumps({'error': str(e)}))
+            return
+
+        if params.get('format', ['json'])[0] == 'csv':
+            output = io.StringIO()
+            fields = []
+            for row in rows:
+                fields.extend(field for field in row if field not in fields)
+            writer = csv.DictWriter(output, fields)
+            writer.writeheader()
+            writer.writerows(rows)
+            self._send(200, 'text/csv', output.getvalue())
+        else:
+            self._send(200, 'application/json', json.dumps(rows))
+
+    def _send(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for the REDCap API, serving the projects of a JSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('data', help='JSON file with the metadata and records of each API token')
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        with open(options['data']) as data_file:
+            RedcapStubHandler.projects = json.load(data_file)
+        server = ThreadingHTTPServer(('localhost', options['port']), RedcapStubHandler)
+        self.stdout.write('REDCap stub listening on http://localhost:{}/api/'.format(options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,12 @@
+"""Bring the case grants in line with the permissions active now, see clinical.models.rebuild_case_grants."""
+from django.core.management.base import BaseCommand
+
+from clinical.models import rebuild_case_grants
+
+
+class Command(BaseCommand):
+    help = 'Drop the expired case grants and add the ones of the permissions which started, to run every few minutes.'
+
+    def handle(self, *args, **options):
+        written, deleted = rebuild_case_grants()
+        self.stdout.write('{} grants written, {} deleted'.format(written, deleted))
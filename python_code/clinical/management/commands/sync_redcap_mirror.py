@@ -0,0 +1,16 @@
+"""Synchronize the local mirror of the REDCap projects, see clinical.redcap_mirror."""
+from django.core.management.base import BaseCommand
+
+from clinical.redcap_mirror import sync_redcap_mirror
+
+
+class Command(BaseCommand):
+    help = 'Export the REDCap records modified since the last synchronization into the local mirror.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Export all the records again, dropping the ones deleted from REDCap')
+
+    def handle(self, *args, **options):
+        for project, count in sync_redcap_mirror(options['full']).items():
+            self.stdout.write('{}: {} records updated'.format(project, count))
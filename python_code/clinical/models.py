@@ -1,9 +1,16 @@
 """Models for the clinical app."""
 from __future__ import unicode_literals
 
+import operator
+from functools import reduce
+
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .signals import synonyms_changed
 
 
 class Project(models.Model):
@@ -39,6 +46,7 @@ class Patient(models.Model):
     # AAUH - This is the first record_id on the Redcap "Relaps - Inclusions" project for this patient
     centre_patient_id = models.CharField(max_length=36, verbose_name='Patient ID')
     birthdate = models.DateField()
+    updated_dt = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         """Create database table."""
@@ -76,6 +84,9 @@ class Case(models.Model):
     status = models.CharField(blank=True, null=True, max_length=64, choices=STATUS_CHOICES)
     status_date = models.DateField(blank=True, null=True)
     regimen = models.CharField(max_length=200, blank=True, null=True)
+    updated_dt = models.DateTimeField(auto_now=True, db_index=True)
+    # Cached result of Treatment.summarize, None when it has to be computed again (see get_treatment_summaries)
+    treatment_summary = models.TextField(blank=True, null=True)
 
     class Meta:
         """Create database table."""
@@ -93,6 +104,11 @@ class Case(models.Model):
         # See issue #90 on Github
         return 'Project case ID {}'.format(self.project_case_id)
 
+    @staticmethod
+    def get_by_diagnosis_subtree(diagnosis):
+        """Return the cases diagnosed with this diagnosis or one of its descendants."""
+        return Case.objects.filter(diagnosis__ancestor_links__ancestor=diagnosis)
+
 
 class Permission(models.Model):
     granted = models.ForeignKey(User, models.CASCADE, related_name='granted_user')
@@ -110,8 +126,35 @@ class Permission(models.Model):
             self.case.id) + ' from ' + self.granter.username + ' to ' + self.granted.username
 
 
+class CaseGrant(models.Model):
+    """Active permissions merged by user and case, see rebuild_case_grants."""
+
+    user = models.ForeignKey(User, models.CASCADE)
+    case = models.ForeignKey('Case', models.CASCADE)
+    end_dt = models.DateTimeField(blank=True, null=True)  # end of the latest permission, None if one never ends
+
+    class Meta:
+        """Name of table in DB."""
+
+        db_table = 'case_grant'
+        unique_together = ('user', 'case')
+        index_together = ('end_dt',)
+
+    @staticmethod
+    def active(now=None):
+        """Grants not expired yet, the sweep may not have deleted all the expired ones."""
+        now = now or timezone.now()
+        return CaseGrant.objects.filter(models.Q(end_dt__isnull=True) | models.Q(end_dt__gt=now))
+
+
 class Morphology(models.Model):
-    """Morphology model, just a reference, look at MorphologySynonym for codes and descriptions."""
+    """Morphology model, just a reference, look at MorphologySynonym for codes and descriptions.
+
+    The code and label columns are materialized from the synonyms, see rebuild_labels.
+    """
+
+    code = models.CharField(max_length=200, blank=True, null=True)
+    label = models.CharField(max_length=1000, blank=True, null=True)
 
     class Meta:
         """Table name in DB."""
@@ -120,39 +163,36 @@ class Morphology(models.Model):
 
     def __str__(self):
         """Str function used when printing the object."""
-        synonyms = MorphologySynonym.objects.filter(morphology=self)
-        icdo3_name_synonym = synonyms.filter(type__exact='icdo_name').first()
-        icdo3_code_synonym = synonyms.filter(type__exact='icdo_code').first()
-        pato_name_synonym = synonyms.filter(type__exact='pato_name').first()
-        pato_code_synonym = synonyms.filter(type__exact='pato_code').first()
-
-        if icdo3_name_synonym is not None and icdo3_code_synonym is not None:
-            return icdo3_code_synonym.description + ' - ' + icdo3_name_synonym.description
-
-        elif pato_name_synonym is not None and pato_code_synonym is not None:
-            return pato_code_synonym.description + ' - ' + pato_name_synonym.description
+        if self.label is None:
+            materialize_labels(self)
+        return self.label
 
-        elif icdo3_name_synonym is not None:
-            return icdo3_name_synonym.description
-
-        elif pato_name_synonym is not None:
-            return pato_name_synonym.description
+    @staticmethod
+    def labels_from_synonyms(synonyms):
+        """Compute the materialized columns from the first synonym description of each type."""
+        icdo3_name = synonyms.get('icdo_name')
+        icdo3_code = synonyms.get('icdo_code')
+        pato_name = synonyms.get('pato_name')
+        pato_code = synonyms.get('pato_code')
 
-        elif icdo3_code_synonym is not None:
-            return icdo3_code_synonym.description
+        if icdo3_name is not None and icdo3_code is not None:
+            label = icdo3_code + ' - ' + icdo3_name
 
-        elif pato_code_synonym is not None:
-            return pato_code_synonym.description
+        elif pato_name is not None and pato_code is not None:
+            label = pato_code + ' - ' + pato_name
 
         else:
-            return 'Undefined'
+            label = next((description for description in (icdo3_name, pato_name, icdo3_code, pato_code)
+                          if description is not None), 'Undefined')
+
+        return {'code': icdo3_code if icdo3_code is not None else pato_code, 'label': label}
 
     @staticmethod
     def get_by_icdo3_code(icdo3_code):
-        synonyms = MorphologySynonym.objects.filter(type__exact='icdo_code', description__iexact=icdo3_code)
-        if synonyms.exists():
-            return synonyms.get().morphology
-        return None
+        """Return the morphology with this code, see ontology_utils.morphology_codes to resolve ids in bulk."""
+        from .ontology_utils import morphology_codes
+        morphology_id = morphology_codes.resolve(icdo3_code)
+        return Morphology.objects.get(pk=morphology_id) if morphology_id is not None else None
 
 
 class MorphologySynonym(models.Model):
@@ -169,7 +209,13 @@ class MorphologySynonym(models.Model):
 
 
 class Topography(models.Model):
-    """Topography model, i.e. the location of the sample/tumour."""
+    """Topography model, i.e. the location of the sample/tumour.
+
+    The code and label columns are materialized from the synonyms, see rebuild_labels.
+    """
+
+    code = models.CharField(max_length=200, blank=True, null=True)
+    label = models.CharField(max_length=1000, blank=True, null=True)
 
     class Meta:
         """Table name in DB."""
@@ -178,44 +224,40 @@ class Topography(models.Model):
 
     def __str__(self):
         """Str function used when printing the object."""
-        synonyms = TopographySynonym.objects.filter(topography=self)
-        icdo3_name_synonym = synonyms.filter(type__exact='icdo_name').first()
-        icdo3_code_synonym = synonyms.filter(type__exact='icdo_code').first()
-        pato_name_synonym = synonyms.filter(type__exact='pato_name').first()
-        pato_code_synonym = synonyms.filter(type__exact='pato_code').first()
+        if self.label is None:
+            materialize_labels(self)
+        return self.label
 
-        if icdo3_name_synonym is not None and icdo3_code_synonym is not None \
-                and pato_name_synonym is not None and pato_code_synonym is not None:
-            return '{} - {} ({} - {})'.format(icdo3_code_synonym.description, icdo3_name_synonym.description,
-                                              pato_code_synonym.description, pato_name_synonym.description)
-
-        elif icdo3_name_synonym is not None and icdo3_code_synonym is not None:
-            return icdo3_code_synonym.description + ' - ' + icdo3_name_synonym.description
-
-        elif pato_name_synonym is not None and pato_code_synonym is not None:
-            return pato_code_synonym.description + ' - ' + pato_name_synonym.description
-
-        elif icdo3_name_synonym is not None:
-            return icdo3_name_synonym.description
+    @staticmethod
+    def labels_from_synonyms(synonyms):
+        """Compute the materialized columns from the first synonym description of each type."""
+        icdo3_name = synonyms.get('icdo_name')
+        icdo3_code = synonyms.get('icdo_code')
+        pato_name = synonyms.get('pato_name')
+        pato_code = synonyms.get('pato_code')
 
-        elif pato_name_synonym is not None:
-            return pato_name_synonym.description
+        if icdo3_name is not None and icdo3_code is not None \
+                and pato_name is not None and pato_code is not None:
+            label = '{} - {} ({} - {})'.format(icdo3_code, icdo3_name, pato_code, pato_name)
 
-        elif icdo3_code_synonym is not None:
-            return icdo3_code_synonym.description
+        elif icdo3_name is not None and icdo3_code is not None:
+            label = icdo3_code + ' - ' + icdo3_name
 
-        elif pato_code_synonym is not None:
-            return pato_code_synonym.description
+        elif pato_name is not None and pato_code is not None:
+            label = pato_code + ' - ' + pato_name
 
         else:
-            return 'Undefined'
+            label = next((description for description in (icdo3_name, pato_name, icdo3_code, pato_code)
+                          if description is not None), 'Undefined')
+
+        return {'code': icdo3_code if icdo3_code is not None else pato_code, 'label': label}
 
     @staticmethod
     def get_by_icdo3_code(icdo3_code):
-        refs = TopographySynonym.objects.filter(type__exact='icdo_code', description__iexact=icdo3_code)
-        if refs.exists():
-            return refs.get().topography
-        return None
+        """Return the topography with this code, see ontology_utils.topography_codes to resolve ids in bulk."""
+        from .ontology_utils import topography_codes
+        topography_id = topography_codes.resolve(icdo3_code)
+        return Topography.objects.get(pk=topography_id) if topography_id is not None else None
 
 
 class TopographySynonym(models.Model):
@@ -232,42 +274,64 @@ class TopographySynonym(models.Model):
 
 
 class Diagnosis(models.Model):
-    """Diagnosis model, just a reference, look at DiagnosisSynonym for codes and descriptions."""
+    """Diagnosis model, just a reference, look at DiagnosisSynonym for codes and descriptions.
+
+    The code and label columns are materialized from the synonyms, see rebuild_labels.
+    """
 
     parent = models.ForeignKey('Diagnosis', null=True, on_delete=models.CASCADE)
+    code = models.CharField(max_length=300, blank=True, null=True)
+    label = models.CharField(max_length=1000, blank=True, null=True)
 
     def __str__(self):
         """Str function used when printing the object."""
-        synonyms = DiagnosisSynonym.objects.filter(diagnosis=self).all()
-
-        name_synonym = synonyms.filter(type__exact='icd10_name').first()
-        if name_synonym is None:
-            name_synonym = synonyms.filter(type__exact='sks_name').first()
-
-        code_synonym = synonyms.filter(type__exact='icd10_code').first()
-        if code_synonym is None:
-            code_synonym = synonyms.filter(type__exact='sks_code').first()
-
-        if name_synonym is None and code_synonym is None:
-            return 'Undefined'
-        elif name_synonym is None:
-            return code_synonym.description
-        elif code_synonym is None:
-            return name_synonym.description
-        else:
-            return code_synonym.description + ' - ' + name_synonym.description
+        if self.label is None:
+            materialize_labels(self)
+        return self.label
 
     class Meta:
         """Name of table in DB."""
 
         db_table = 'diagnosis'
 
+    @staticmethod
+    def labels_from_synonyms(synonyms):
+        """Compute the materialized columns from the first synonym description of each type."""
+        name = synonyms.get('icd10_name', synonyms.get('sks_name'))
+        code = synonyms.get('icd10_code', synonyms.get('sks_code'))
+
+        if name is None and code is None:
+            label = 'Undefined'
+        elif name is None:
+            label = code
+        elif code is None:
+            label = name
+        else:
+            label = code + ' - ' + name
+
+        return {'code': code, 'label': label}
+
+    def get_descendants(self, include_self=True):
+        """Return the diagnoses below this one in the hierarchy, through the closure table."""
+        if include_self:
+            return Diagnosis.objects.filter(ancestor_links__ancestor=self)
+        # Both conditions in one filter() so that they apply to the same link
+        return Diagnosis.objects.filter(ancestor_links__ancestor=self, ancestor_links__depth__gt=0)
+
+    def get_ancestors(self, include_self=True):
+        """Return the diagnoses above this one in the hierarchy, the closest first."""
+        if include_self:
+            ancestors = Diagnosis.objects.filter(descendant_links__descendant=self)
+        else:
+            ancestors = Diagnosis.objects.filter(descendant_links__descendant=self, descendant_links__depth__gt=0)
+        return ancestors.order_by('descendant_links__depth')
+
     @staticmethod
     def get_by_icd10_code(code):
-        diag = DiagnosisSynonym.objects.filter(type__exact='icd10_code', description__iexact=code)
-        if diag.exists():
-            return diag.get().diagnosis
-        return None
+        """Return the diagnosis with this code, see ontology_utils.diagnosis_codes to resolve ids in bulk."""
+        from .ontology_utils import diagnosis_codes
+        diagnosis_id = diagnosis_codes.resolve(code)
+        return Diagnosis.objects.get(pk=diagnosis_id) if diagnosis_id is not None else None
 
 
 class DiagnosisSynonym(models.Model):
@@ -283,6 +347,23 @@ class DiagnosisSynonym(models.Model):
         db_table = 'diagnosis_synonym'
 
 
+class DiagnosisAncestor(models.Model):
+    """Closure table of the Diagnosis hierarchy: one row per (ancestor, descendant) pair, itself included (depth 0).
+
+    Maintained by rebuild_diagnosis_closure, it turns "this diagnosis and its subtree" into a single join.
+    """
+
+    ancestor = models.ForeignKey('Diagnosis', on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey('Diagnosis', on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        """Name of table in DB."""
+
+        db_table = 'diagnosis_closure'
+        unique_together = ('ancestor', 'descendant')
+
+
 TREAT_TYPES = (
     ('cycl', 'Cycle drug'),
     ('cont', 'Continuous drug'),
@@ -332,9 +413,48 @@ class Treatment(models.Model):
         known_treatment(self.treat_type)
         super(Treatment, self).save(*args, **kwargs)
 
+    @staticmethod
+    def summarize(treatments):
+        """Summary of the treatments of a case: the names of the drugs and the other treatment types, or '-'."""
+        drug_lst = []
+        treat_lst = []
+        for elem in treatments:
+            drug_name = elem.drug.off_name_str() if elem.drug else 'Undefined'
+            if drug_name != 'Undefined':
+                drug_lst.append(drug_name)
+            treat_type = elem.treat_type
+            if treat_type not in ['cont', 'cycl', 'cond']:
+                if treat_type == 'allo':
+                    treat_lst.append('Allotrans.')
+                elif treat_type == 'waw':
+                    treat_lst.append('WAW')
+                elif treat_type == 'rad':
+                    treat_lst.append('RT')
+                elif treat_type == 'auto':
+                    treat_lst.append('Autotrans.')
+                elif treat_type == 'surg':
+                    treat_lst.append('Surgery')
+                elif treat_type == 'exptr' and elem.drug is None:
+                    treat_lst.append('Experimental')
+                else:
+                    treat_lst.append('Other')
+
+        # converting to the list to a set removes duplicates.
+        drug_and_treatment_lst = sorted(set(drug_lst)) + sorted(set(treat_lst))
+        if len(drug_and_treatment_lst) == 0:
+            return '-'
+        return ', '.join(drug_and_treatment_lst)
+
 
 class Drug(models.Model):
-    """Drug model, just a reference, look at DrugSynonym for codes and descriptions."""
+    """Drug model, just a reference, look at DrugSynonym for codes and descriptions.
+
+    The code, name and label columns are materialized from the synonyms, see rebuild_labels.
+    """
+
+    code = models.CharField(max_length=200, blank=True, null=True)
+    name = models.CharField(max_length=200, blank=True, null=True)
+    label = models.CharField(max_length=500, blank=True, null=True)
 
     class Meta:
         """Table name in DB."""
@@ -343,38 +463,38 @@ class Drug(models.Model):
 
     def __str__(self):
         """Str function used when printing the object."""
-        synonyms = DrugSynonym.objects.filter(drug=self)
-        code_synonym = synonyms.filter(type__exact='code').first()
-        name_synonym = synonyms.filter(type__exact='official_name').first()
-
-        if name_synonym is None and code_synonym is None:
-            return 'Undefined'
-        elif name_synonym is None:
-            return code_synonym.description
-        elif code_synonym is None:
-            return name_synonym.description
-        else:
-            return code_synonym.description + ' - ' + name_synonym.description
+        if self.label is None:
+            materialize_labels(self)
+        return self.label
 
     def code_str(self):
         """Str function used when printing the object."""
-        synonyms = DrugSynonym.objects.filter(drug=self)
-        code_synonym = synonyms.filter(type__exact='code').first()
-
-        if code_synonym is None:
-            return 'Undefined'
-        else:
-            return code_synonym.description
+        if self.label is None:
+            materialize_labels(self)
+        return self.code if self.code is not None else 'Undefined'
 
     def off_name_str(self):
         """Str function used when printing the object."""
-        synonyms = DrugSynonym.objects.filter(drug=self)
-        name_synonym = synonyms.filter(type__exact='official_name').first()
+        if self.label is None:
+            materialize_labels(self)
+        return self.name if self.name is not None else 'Undefined'
 
-        if name_synonym is None:
-            return 'Undefined'
+    @staticmethod
+    def labels_from_synonyms(synonyms):
+        """Compute the materialized columns from the first synonym description of each type."""
+        code = synonyms.get('code')
+        name = synonyms.get('official_name')
+
+        if name is None and code is None:
+            label = 'Undefined'
+        elif name is None:
+            label = code
+        elif code is None:
+            label = name
         else:
-            return name_synonym.description
+            label = code + ' - ' + name
+
+        return {'code': code, 'name': name, 'label': label}
 
 
 class DrugSynonym(models.Model):
@@ -389,6 +509,70 @@ class DrugSynonym(models.Model):
 
         db_table = 'drug_synonym'
 
+
+# Ontology model -> (synonym model, name of the foreign key on the synonym model)
+SYNONYM_MODELS = {
+    Morphology: (MorphologySynonym, 'morphology'),
+    Topography: (TopographySynonym, 'topography'),
+    Diagnosis: (DiagnosisSynonym, 'diagnosis'),
+    Drug: (DrugSynonym, 'drug'),
+}
+
+
+def first_synonyms(model, ids=None):
+    """Map the ids of an ontology model to the first synonym description of each type, in one query."""
+    synonym_model, parent_field = SYNONYM_MODELS[model]
+    synonyms = synonym_model.objects.order_by('id')
+    if ids is not None:
+        synonyms = synonyms.filter(**{parent_field + '_id__in': ids})
+
+    result = {}
+    for parent_id, synonym_type, description in synonyms.values_list(parent_field + '_id', 'type', 'description'):
+        result.setdefault(parent_id, {}).setdefault(synonym_type, description)
+    return result
+
+
+def rebuild_labels(model, ids=None):
+    """Recompute the materialized code/label columns of an ontology model (all rows when ids is None).
+
+    Only the rows whose values changed are updated. Returns the computed values by id.
+    """
+    synonyms = first_synonyms(model, ids)
+    rows = model.objects.all() if ids is None else model.objects.filter(id__in=ids)
+    field_names = list(model.labels_from_synonyms({}))
+
+    computed = {}
+    with transaction.atomic():
+        for row in rows.values('id', *field_names):
+            values = model.labels_from_synonyms(synonyms.get(row['id'], {}))
+            if any(row[name] != value for name, value in values.items()):
+                model.objects.filter(id=row['id']).update(**values)
+            computed[row['id']] = values
+    return computed
+
+
+def materialize_labels(instance):
+    """Fill the label columns of an instance that was saved before its labels were materialized."""
+    model = type(instance)
+    if instance.id is None:
+        values = model.labels_from_synonyms({})
+    else:
+        values = rebuild_labels(model, [instance.id]).get(instance.id, model.labels_from_synonyms({}))
+    for name, value in values.items():
+        setattr(instance, name, value)
+
+
+@receiver([models.signals.post_save, models.signals.post_delete], sender=MorphologySynonym)
+@receiver([models.signals.post_save, models.signals.post_delete], sender=TopographySynonym)
+@receiver([models.signals.post_save, models.signals.post_delete], sender=DiagnosisSynonym)
+@receiver([models.signals.post_save, models.signals.post_delete], sender=DrugSynonym)
+def refresh_labels_on_synonym_change(sender, instance, **kwargs):
+    """Keep the materialized labels of the ontology models in sync with their synonyms."""
+    model = next(model for model, (synonym_model, _) in SYNONYM_MODELS.items() if synonym_model is sender)
+    parent_id = getattr(instance, SYNONYM_MODELS[model][1] + '_id')
+    rebuild_labels(model, [parent_id])
+    synonyms_changed.send(sender=model, ids=[parent_id])
+
 LEVEL = (
     (1, 'Level 1'), (2, 'Level 2A'), (3, 'Level 2B'), (4, 'Level 3A'), (5, 'Level 3B'),
     (6, 'Level 4'), (7, 'Level R1'),
@@ -424,4 +608,226 @@ class Reference(models.Model):
     type = models.CharField(max_length=300)
     description = models.CharField(max_length=300)
 
-    reference_gives_details = models.ManyToManyField('DrugEffect')
\ No newline at end of file
+    reference_gives_details = models.ManyToManyField('DrugEffect')
+
+
+class RedcapRecord(models.Model):
+    """Local mirror of a row of a REDCap project export, see redcap_mirror."""
+
+    project = models.CharField(max_length=20)  # key of redcap_mirror.REDCAP_PROJECTS
+    record_id = models.CharField(max_length=100)
+    data = models.TextField()  # the exported row, as JSON
+
+    class Meta:
+        """Name of table in DB."""
+
+        db_table = 'redcap_record'
+        index_together = ('project', 'record_id')
+
+
+class RedcapSync(models.Model):
+    """Times of the synchronizations of the local mirror of a REDCap project."""
+
+    project = models.CharField(max_length=20, unique=True)
+    synced_dt = models.DateTimeField()
+    changed_dt = models.DateTimeField()  # last synchronization which changed the mirrored records
+
+    class Meta:
+        """Name of table in DB."""
+
+        db_table = 'redcap_sync'
+
+
+def rebuild_diagnosis_closure(root_ids=None, batch_size=500):
+    """Bring the closure table in line with Diagnosis.parent, for the subtrees of root_ids (everything when None).
+
+    The hierarchy is walked in memory, then only the missing rows are inserted and the stale ones deleted.
+    Returns the number of rows inserted and deleted.
+    """
+    parents = dict(Diagnosis.objects.values_list('id', 'parent_id'))
+
+    if root_ids is None:
+        nodes = list(parents)
+    else:
+        children = {}
+        for diagnosis_id, parent_id in parents.items():
+            children.setdefault(parent_id, []).append(diagnosis_id)
+        nodes = []
+        pending = [diagnosis_id for diagnosis_id in root_ids if diagnosis_id in parents]
+        while pending:
+            diagnosis_id = pending.pop()
+            nodes.append(diagnosis_id)
+            pending.extend(children.get(diagnosis_id, []))
+
+    expected = set()
+    for diagnosis_id in nodes:
+        ancestor_id, depth, seen = diagnosis_id, 0, set()
+        while ancestor_id is not None and ancestor_id not in seen:  # the seen set guards against cycles
+            expected.add((ancestor_id, diagnosis_id, depth))
+            seen.add(ancestor_id)
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+
+    links = DiagnosisAncestor.objects.values_list('id', 'ancestor_id', 'descendant_id', 'depth')
+    if root_ids is None:
+        existing = {link[1:]: link[0] for link in links.iterator()}
+    else:
+        existing = {}
+        for start in range(0, len(nodes), batch_size):
+            existing.update((link[1:], link[0]) for link in links.filter(descendant_id__in=nodes[start:start + batch_size]))
+
+    stale_ids = [link_id for link, link_id in existing.items() if link not in expected]
+    missing = [DiagnosisAncestor(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth)
+               for ancestor_id, descendant_id, depth in expected if (ancestor_id, descendant_id, depth) not in existing]
+
+    with transaction.atomic():
+        for start in range(0, len(stale_ids), batch_size):
+            DiagnosisAncestor.objects.filter(id__in=stale_ids[start:start + batch_size]).delete()
+        DiagnosisAncestor.objects.bulk_create(missing, batch_size=batch_size)
+    return len(missing), len(stale_ids)
+
+
+def move_diagnosis_subtree(diagnosis_id, parent_id, batch_size=500):
+    """Update the closure table for a diagnosis created, or moved under parent_id, with its subtree.
+
+    Only the links from the subtree to its previous ancestors are deleted and the ones to its new ancestors inserted,
+    the links inside the subtree staying valid.
+    """
+    subtree = dict(DiagnosisAncestor.objects.filter(ancestor_id=diagnosis_id).values_list('descendant_id', 'depth'))
+    ancestors = []
+    if parent_id is not None:
+        ancestors = list(DiagnosisAncestor.objects.filter(descendant_id=parent_id).values_list('ancestor_id', 'depth'))
+        if not ancestors or any(ancestor_id in subtree for ancestor_id, _ in ancestors):
+            # Parent missing from the closure table, or moved under its own subtree
+            rebuild_diagnosis_closure([diagnosis_id], batch_size)
+            return
+
+    subtree_ids = DiagnosisAncestor.objects.filter(ancestor_id=diagnosis_id).values('descendant_id')
+    with transaction.atomic():
+        DiagnosisAncestor.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+        links = [DiagnosisAncestor(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth + 1 + ancestor_depth)
+                 for descendant_id, depth in subtree.items() for ancestor_id, ancestor_depth in ancestors]
+        if not subtree:
+            links.append(DiagnosisAncestor(ancestor_id=diagnosis_id, descendant_id=diagnosis_id, depth=0))
+            links.extend(DiagnosisAncestor(ancestor_id=ancestor_id, descendant_id=diagnosis_id, depth=1 + ancestor_depth)
+                         for ancestor_id, ancestor_depth in ancestors)
+        DiagnosisAncestor.objects.bulk_create(links, batch_size=batch_size)
+
+
+@receiver(models.signals.post_init, sender=Diagnosis)
+def remember_diagnosis_parent(sender, instance, **kwargs):
+    instance._loaded_parent_id = instance.parent_id
+
+
+@receiver(models.signals.post_save, sender=Diagnosis)
+def refresh_closure_on_diagnosis_save(sender, instance, created, **kwargs):
+    """Keep the closure table in line with the hierarchy when a diagnosis is created or moved."""
+    if created or instance.parent_id != instance._loaded_parent_id:
+        move_diagnosis_subtree(instance.id, instance.parent_id)
+    instance._loaded_parent_id = instance.parent_id
+
+
+def rebuild_case_grants(pairs=None, batch_size=500):
+    """Bring the grants in line with the permissions active now, for the (user id, case id) pairs (all when None).
+
+    A grant exists for a user and a case while one of the permissions of the user on the case has started and not ended,
+    the permissions starting later are granted by the first rebuild after their start. Run regularly (see the
+    sweep_case_grants command) to drop the expired grants and add the ones starting.
+    Returns the number of grants written and deleted.
+    """
+    now = timezone.now()
+    permissions = Permission.objects.filter(created_dt__lte=now).filter(
+        models.Q(end_dt__isnull=True) | models.Q(end_dt__gt=now))
+    grants = CaseGrant.objects.all()
+    if pairs is not None:
+        # Meant for a few pairs, the ones of the permissions just changed
+        pairs = set(pairs)
+        if not pairs:
+            return 0, 0
+        permissions = permissions.filter(reduce(operator.or_, (models.Q(granted_id=user_id, case_id=case_id)
+                                                              for user_id, case_id in pairs)))
+        grants = grants.filter(reduce(operator.or_, (models.Q(user_id=user_id, case_id=case_id)
+                                                    for user_id, case_id in pairs)))
+
+    expected = {}
+    for user_id, case_id, end_dt in permissions.values_list('granted_id', 'case_id', 'end_dt').iterator():
+        key = (user_id, case_id)
+        # The grant lasts until the end of the latest permission, forever if one has no end
+        if key not in expected:
+            expected[key] = end_dt
+        elif expected[key] is not None and (end_dt is None or end_dt > expected[key]):
+            expected[key] = end_dt
+
+    existing = {(user_id, case_id): (grant_id, end_dt)
+                for grant_id, user_id, case_id, end_dt in grants.values_list('id', 'user_id', 'case_id', 'end_dt')}
+    stale_ids = [grant_id for key, (grant_id, _) in existing.items() if key not in expected]
+    changed = [(existing[key][0], end_dt) for key, end_dt in expected.items()
+               if key in existing and existing[key][1] != end_dt]
+    missing = [CaseGrant(user_id=user_id, case_id=case_id, end_dt=end_dt)
+               for (user_id, case_id), end_dt in expected.items() if (user_id, case_id) not in existing]
+
+    with transaction.atomic():
+        for start in range(0, len(stale_ids), batch_size):
+            CaseGrant.objects.filter(id__in=stale_ids[start:start + batch_size]).delete()
+        for grant_id, end_dt in changed:
+            CaseGrant.objects.filter(id=grant_id).update(end_dt=end_dt)
+        CaseGrant.objects.bulk_create(missing, batch_size=batch_size)
+    return len(missing) + len(changed), len(stale_ids)
+
+
+@receiver(models.signals.pre_save, sender=Permission)
+def remember_permission_grant_pair(sender, instance, **kwargs):
+    """Keep the (user, case) of a permission before it is changed, its grant has to be rebuilt as well."""
+    instance._previous_grant_pair = None
+    if instance.pk is not None:
+        instance._previous_grant_pair = Permission.objects.filter(pk=instance.pk).values_list(
+            'granted_id', 'case_id').first()
+
+
+@receiver([models.signals.post_save, models.signals.post_delete], sender=Permission)
+def refresh_grants_on_permission_change(sender, instance, **kwargs):
+    """Keep the grants of the user on the case (and on the previous ones) in line with their permissions."""
+    pairs = {(instance.granted_id, instance.case_id)}
+    previous = getattr(instance, '_previous_grant_pair', None)
+    if previous is not None:
+        pairs.add(previous)
+    rebuild_case_grants(list(pairs))
+
+
+def get_treatment_summaries(cases, batch_size=500):
+    """Return the treatment summaries of the cases by case id.
+
+    The cached summaries are used as they are, the missing ones are computed from one joined query per batch of
+    cases and stored on the cases.
+    """
+    summaries = {case.id: case.treatment_summary for case in cases if case.treatment_summary is not None}
+    missing_ids = [case.id for case in cases if case.id not in summaries]
+    for start in range(0, len(missing_ids), batch_size):
+        ids = missing_ids[start:start + batch_size]
+        treatments = {case_id: [] for case_id in ids}
+        for treatment in Treatment.objects.filter(case_id__in=ids).select_related('drug').order_by('case_id', 'treat_instance'):
+            treatments[treatment.case_id].append(treatment)
+        batch = {case_id: Treatment.summarize(case_treatments) for case_id, case_treatments in treatments.items()}
+        Case.objects.filter(id__in=ids).update(treatment_summary=models.Case(
+            *[models.When(id=case_id, then=models.Value(summary)) for case_id, summary in batch.items()],
+            output_field=models.TextField()
+        ))
+        summaries.update(batch)
+    for case in cases:
+        case.treatment_summary = summaries[case.id]
+    return summaries
+
+
+@receiver([models.signals.post_save, models.signals.post_delete], sender=Treatment)
+def clear_treatment_summary(sender, instance, **kwargs):
+    """The summary of the case is computed again the next time it is needed."""
+    Case.objects.filter(id=instance.case_id).update(treatment_summary=None)
+
+
+@receiver(synonyms_changed, sender=Drug)
+def clear_treatment_summaries_on_drug_change(sender, ids=None, **kwargs):
+    """The summaries contain the names of the drugs."""
+    cases = Case.objects.exclude(treatment_summary=None)
+    if ids is not None:
+        cases = cases.filter(treatment__drug_id__in=ids)
+    cases.update(treatment_summary=None)
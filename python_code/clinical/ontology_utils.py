@@ -0,0 +1,100 @@
+"""Helpers shared by the per-process caches built over the ontology models (Morphology, Topography, Diagnosis, Drug).
+
+Every web worker keeps its own copy of these caches. To invalidate them in all the workers, a version number per
+ontology model is kept in the Django cache and bumped whenever synonyms change: a worker compares the version its copy
+was built with to the current one before using it.
+"""
+import abc
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.dispatch import receiver
+
+from .models import SYNONYM_MODELS, Diagnosis, Morphology, Topography
+from .signals import synonyms_changed
+
+logger = logging.getLogger('django')
+
+
+def _version_key(model):
+    return 'clinical:ontology_version:{}'.format(model.__name__.lower())
+
+
+def get_ontology_version(model):
+    """Return the current version of the synonyms of an ontology model."""
+    return cache.get(_version_key(model), 0)
+
+
+def bump_ontology_version(model):
+    """Invalidate the caches built over an ontology model, in every process."""
+    try:
+        cache.incr(_version_key(model))
+    except ValueError:
+        # The key is not in the cache (yet or anymore): start from a value no worker can have seen before
+        cache.set(_version_key(model), int(time.time() * 1000), None)
+
+
+@receiver(synonyms_changed)
+def invalidate_on_synonyms_changed(sender, **kwargs):
+    bump_ontology_version(sender)
+
+
+class OntologyCache(abc.ABC):
+    """Data built from an ontology model, kept per process and rebuilt when the version of its synonyms changes."""
+
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+        self._data = None
+        self._version = None
+
+    def get(self):
+        """Return the up-to-date data, building it if needed."""
+        version = get_ontology_version(self.model)
+        if self._data is None or self._version != version:
+            with self._lock:
+                if self._data is None or self._version != version:
+                    self._data = self.build()
+                    self._version = version
+        return self._data
+
+    @abc.abstractmethod
+    def build(self):
+        """Return the data, built from the current rows of the model."""
+
+
+class CodeResolver(OntologyCache):
+    """Resolve the codes of an ontology model (case-insensitively) to row ids without querying the database."""
+
+    def __init__(self, model, code_type):
+        super(CodeResolver, self).__init__(model)
+        self.code_type = code_type
+
+    def build(self):
+        synonym_model, parent_field = SYNONYM_MODELS[self.model]
+        codes = synonym_model.objects.filter(type__exact=self.code_type).values_list('description', parent_field + '_id')
+        ids = {}
+        for code, row_id in codes.iterator():
+            folded = code.strip().casefold()
+            if ids.setdefault(folded, row_id) not in (row_id, None):
+                logger.warning('The {} code {} is used by more than one row'.format(self.model.__name__, code))
+                ids[folded] = None
+        return ids
+
+    def resolve(self, code):
+        """Return the id of the row with this code, or None if it is unknown (or ambiguous)."""
+        if code is None:
+            return None
+        return self.get().get(code.strip().casefold())
+
+    def resolve_many(self, codes):
+        """Return a dict code -> id (or None) for all the codes, at most one query to build the map."""
+        ids = self.get()
+        return {code: None if code is None else ids.get(code.strip().casefold()) for code in codes}
+
+
+morphology_codes = CodeResolver(Morphology, 'icdo_code')
+topography_codes = CodeResolver(Topography, 'icdo_code')
+diagnosis_codes = CodeResolver(Diagnosis, 'icd10_code')
@@ -0,0 +1,76 @@
+"""Caching layer around the REDCap helpers of the aauh module.
+
+The data dictionary of a project almost never changes and is kept for a day, the records for a minute (see the
+REDCAP_DICTIONARY_CACHE_TTL and REDCAP_RECORDS_CACHE_TTL settings, in seconds).
+
+When an entry expires, only one caller (across processes, through cache.add) downloads it again, the others keep
+getting the previous value meanwhile, or wait for the new one if there is no previous value.
+"""
+import hashlib
+import logging
+import time
+
+from aauh.redcap_utils import get_redcap_dictionary, get_redcap_records
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('django')
+
+DEFAULT_DICTIONARY_TTL = 24 * 60 * 60
+DEFAULT_RECORDS_TTL = 60
+
+# How long a caller waits for another one to download an entry which is not in the cache
+REFRESH_WAIT = 30
+
+
+def _cache_key(kind, *args):
+    # The arguments contain the API token, it is hashed rather than stored in the key
+    digest = hashlib.sha256(repr(args).encode('utf-8')).hexdigest()
+    return 'clinical:redcap:{}:{}'.format(kind, digest)
+
+
+def get_or_refresh(key, ttl, compute):
+    """Return the cached value of key, computing it when it is missing or expired, without stampedes."""
+    entry = cache.get(key)  # (expiry time, value)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+
+    lock_key = key + ':lock'
+    if cache.add(lock_key, True, REFRESH_WAIT):
+        try:
+            value = compute()
+            # Expired entries are kept as long again, to be served while they are refreshed
+            cache.set(key, (time.time() + ttl, value), 2 * ttl)
+            return value
+        finally:
+            cache.delete(lock_key)
+
+    if entry is not None:
+        # Someone else is refreshing it
+        return entry[1]
+
+    deadline = time.time() + REFRESH_WAIT
+    while time.time() < deadline and cache.get(lock_key) is not None:
+        time.sleep(0.1)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[1]
+    # The lock may have been released since the last read
+    entry = cache.get(key)
+    if entry is not None:
+        return entry[1]
+    logger.warning('Gave up waiting for the REDCap data to be downloaded by another request')
+    return compute()
+
+
+def get_cached_redcap_dictionary(token):
+    """Cached get_redcap_dictionary."""
+    ttl = getattr(settings, 'REDCAP_DICTIONARY_CACHE_TTL', DEFAULT_DICTIONARY_TTL)
+    return get_or_refresh(_cache_key('dictionary', token), ttl, lambda: get_redcap_dictionary(token))
+
+
+def get_cached_redcap_records(token, *args):
+    """Cached get_redcap_records, taking the same arguments."""
+    ttl = getattr(settings, 'REDCAP_RECORDS_CACHE_TTL', DEFAULT_RECORDS_TTL)
+    return get_or_refresh(_cache_key('records', token, *args), ttl, lambda: get_redcap_records(token, *args))
@@ -0,0 +1,144 @@
+"""Local mirror of the REDCap clinical and inclusion projects, refreshed incrementally.
+
+Rather than exporting the whole projects for every batch upload, only the records modified since the last
+synchronization are exported (dateRangeBegin parameter of the REDCap API) and replace their previous rows in the
+RedcapRecord table. The CPR -> patient id map used by the batch upload is computed from the mirror by the aauh helper
+find_patient_ids_by_cpr, and kept in memory until the next synchronization changing something.
+
+Deleted records are not reported by the incremental exports, run sync_redcap_mirror --full regularly to drop them.
+
+Settings:
+    - REDCAP_API_URL: URL of the REDCap API used by the mirror, see the redcap_stub_server command for tests. Without
+      it the mirror is disabled, and the projects are exported in full by the aauh helpers at each batch upload as
+      before.
+    - API_CLINICAL_TOKEN and API_INCLUSION_TOKEN: tokens of the mirrored projects.
+"""
+import json
+import logging
+import threading
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+from aauh.get_redcap_data import find_patient_ids_by_cpr, retrieve_redcap_data
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+import pandas
+
+from .models import RedcapRecord, RedcapSync
+
+logger = logging.getLogger('django')
+
+# Mirrored project -> name of the setting holding its API token
+REDCAP_PROJECTS = {
+    'clinical': 'API_CLINICAL_TOKEN',
+    'inclusion': 'API_INCLUSION_TOKEN',
+}
+
+# Events of the clinical project used to find the patients, as in BatchUploadApiEndpoint
+CLINICAL_EVENTS = ('case_arm_1', 'case_arm_2', 'case_arm_3')
+
+RECORD_ID_FIELD = 'record_id'
+
+REDCAP_TIMEOUT = 120
+
+
+def mirror_enabled():
+    return getattr(settings, 'REDCAP_API_URL', None) is not None
+
+
+def export_records(token, date_range_begin=None):
+    """Export the records of a project (only the ones modified since date_range_begin if given) as a list of dicts."""
+    params = {'token': token, 'content': 'record', 'format': 'json', 'type': 'flat', 'rawOrLabel': 'raw'}
+    if date_range_begin is not None:
+        params['dateRangeBegin'] = timezone.localtime(date_range_begin).strftime('%Y-%m-%d %H:%M:%S')
+    with urlopen(settings.REDCAP_API_URL, urlencode(params).encode('utf-8'), timeout=REDCAP_TIMEOUT) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def sync_project(project, full=False):
+    """Bring the mirror of a project up to date, returns the number of records updated."""
+    sync = RedcapSync.objects.filter(project=project).first()
+    since = None if full or sync is None else sync.synced_dt
+    # Taken before the export so that the records modified during it are exported again next time
+    started_dt = timezone.now()
+
+    rows = export_records(getattr(settings, REDCAP_PROJECTS[project]), since)
+    rows_by_record = {}
+    for row in rows:
+        rows_by_record.setdefault(str(row[RECORD_ID_FIELD]), []).append(row)
+
+    with transaction.atomic():
+        if since is None:
+            RedcapRecord.objects.filter(project=project).delete()
+        else:
+            record_ids = list(rows_by_record)
+            for start in range(0, len(record_ids), 500):
+                RedcapRecord.objects.filter(project=project, record_id__in=record_ids[start:start + 500]).delete()
+        RedcapRecord.objects.bulk_create(
+            [RedcapRecord(project=project, record_id=record_id, data=json.dumps(row))
+             for record_id, record_rows in rows_by_record.items() for row in record_rows],
+            batch_size=500
+        )
+        defaults = {'synced_dt': started_dt}
+        if rows_by_record or since is None:
+            defaults['changed_dt'] = started_dt
+        RedcapSync.objects.update_or_create(project=project, defaults=defaults)
+
+    logger.info('REDCap {} project mirror: {} records updated'.format(project, len(rows_by_record)))
+    return len(rows_by_record)
+
+
+def sync_redcap_mirror(full=False):
+    """Synchronize the mirrors of all the projects, nothing is done when the mirror is disabled."""
+    if not mirror_enabled():
+        return {}
+    return {project: sync_project(project, full) for project in REDCAP_PROJECTS}
+
+
+def load_project_frame(project, events=None):
+    """Return the mirrored rows of a project as a DataFrame, typed as the CSV exports read by the aauh helpers.
+
+    The JSON exports only hold strings: the blank values become NaN and the numeric columns numbers, as with read_csv.
+    """
+    rows = [json.loads(data) for data in RedcapRecord.objects.filter(project=project).order_by('id')
+            .values_list('data', flat=True).iterator()]
+    frame = pandas.DataFrame(rows).replace('', float('nan'))
+    frame = frame.apply(pandas.to_numeric, errors='ignore')
+    if events is not None and 'redcap_event_name' in frame:
+        frame = frame.loc[frame['redcap_event_name'].isin(events)]
+    return frame
+
+
+class CprMap:
+    """CPR -> patient id map computed from the mirror, kept until one of the mirrored projects changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._map = None
+        self._version = None
+
+    def get(self):
+        version = tuple(RedcapSync.objects.order_by('project').values_list('project', 'changed_dt'))
+        with self._lock:
+            if self._map is None or self._version != version:
+                clin_df = load_project_frame('clinical', CLINICAL_EVENTS)
+                incl_df = load_project_frame('inclusion')
+                error_records = pandas.DataFrame(columns=['text', 'severity', 'type', 'area'])
+                self._map = find_patient_ids_by_cpr(error_records, incl_df, clin_df)
+                self._version = version
+            return self._map
+
+
+_cpr_map = CprMap()
+
+
+def get_cpr_to_patient_id_dict():
+    """Return the CPR -> patient id map of the mirrored projects, or of full exports when the mirror is disabled."""
+    if not mirror_enabled():
+        clin_df, incl_df, _ = retrieve_redcap_data(events_for_clin=', '.join(CLINICAL_EVENTS))
+        error_records = pandas.DataFrame(columns=['text', 'severity', 'type', 'area'])
+        return find_patient_ids_by_cpr(error_records, incl_df, clin_df)
+    return _cpr_map.get()
@@ -0,0 +1,131 @@
+"""In-memory search index over the synonyms of the ontology models, used by the autocomplete views.
+
+For each ontology model, the index holds:
+ - a sorted array of the (case-folded) synonym descriptions, starting at every word, to find prefix matches by bisection,
+ - a trigram inverted index, to find the descriptions containing the query anywhere,
+ - the materialized label of every row, so that a keystroke is answered without touching the database.
+
+The index is built on first use and rebuilt when the synonyms of the model change (see ontology_utils).
+"""
+import bisect
+import re
+
+from .models import SYNONYM_MODELS, rebuild_labels
+from .ontology_utils import OntologyCache
+
+# Ranks of the matches, best first
+EXACT_MATCH = 0
+PREFIX_MATCH = 1
+WORD_PREFIX_MATCH = 2
+SUBSTRING_MATCH = 3
+
+_WORD_START = re.compile(r'(?:^|(?<=[\s\-/,(]))\S')
+
+
+def fold(text):
+    """Normalize a description or a query for matching."""
+    return ' '.join(text.casefold().split())
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """Immutable index over the synonyms of one ontology model."""
+
+    def __init__(self, descriptions, labels):
+        # descriptions: iterable of (row id, description), labels: dict row id -> label
+        self.labels = labels
+        self.entries = []  # (folded description, row id)
+        self.word_starts = []  # (folded description from a word start, index in entries), sorted
+        self.postings = {}  # trigram -> set of indices in entries
+
+        for row_id, description in descriptions:
+            folded = fold(description)
+            index = len(self.entries)
+            self.entries.append((folded, row_id))
+            for match in _WORD_START.finditer(folded):
+                self.word_starts.append((folded[match.start():], index))
+            for trigram in trigrams(folded):
+                self.postings.setdefault(trigram, set()).add(index)
+        self.word_starts.sort()
+        self.all_ids = sorted(labels)
+
+    def search(self, query):
+        """Return the ids of the rows with a synonym matching the query, best matches first."""
+        query = fold(query)
+        if not query:
+            return self.all_ids
+
+        best = {}  # row id -> (rank, length of the matching description)
+
+        def add(index, rank):
+            folded, row_id = self.entries[index]
+            key = (rank, len(folded))
+            if key < best.get(row_id, (SUBSTRING_MATCH + 1, 0)):
+                best[row_id] = key
+
+        position = bisect.bisect_left(self.word_starts, (query,))
+        while position < len(self.word_starts) and self.word_starts[position][0].startswith(query):
+            index = self.word_starts[position][1]
+            folded = self.entries[index][0]
+            if folded == query:
+                add(index, EXACT_MATCH)
+            elif folded.startswith(query):
+                add(index, PREFIX_MATCH)
+            else:
+                add(index, WORD_PREFIX_MATCH)
+            position += 1
+
+        if len(query) >= 3:
+            candidates = None
+            for trigram in sorted(trigrams(query), key=lambda t: len(self.postings.get(t, ()))):
+                postings = self.postings.get(trigram)
+                if not postings:
+                    candidates = set()
+                    break
+                candidates = set(postings) if candidates is None else candidates & postings
+                if not candidates:
+                    break
+            for index in candidates:
+                if query in self.entries[index][0]:
+                    add(index, SUBSTRING_MATCH)
+        elif not best:
+            # Too short for the trigrams, and no word starting with it: scan the descriptions
+            for index, (folded, _) in enumerate(self.entries):
+                if query in folded:
+                    add(index, SUBSTRING_MATCH)
+
+        return sorted(best, key=lambda row_id: best[row_id] + (row_id,))
+
+
+class OntologySearchIndex(OntologyCache):
+    """Per-process search index of an ontology model, rebuilt when its synonyms change."""
+
+    def search(self, query):
+        return self.get().search(query)
+
+    def label(self, row_id):
+        return self.get().labels.get(row_id, 'Undefined')
+
+    def build(self):
+        synonym_model, parent_field = SYNONYM_MODELS[self.model]
+        descriptions = synonym_model.objects.values_list(parent_field + '_id', 'description').iterator()
+        labels = dict(self.model.objects.values_list('id', 'label'))
+
+        missing = [row_id for row_id, label in labels.items() if label is None]
+        if missing:
+            # Rows created before the labels were materialized
+            computed = rebuild_labels(self.model, missing if len(missing) < 1000 else None)
+            labels.update((row_id, values['label']) for row_id, values in computed.items())
+
+        return SearchIndex(descriptions, labels)
+
+
+_indexes = {model: OntologySearchIndex(model) for model in SYNONYM_MODELS}
+
+
+def get_search_index(model):
+    """Return the shared search index of an ontology model."""
+    return _indexes[model]
@@ -0,0 +1,6 @@
+"""Signals of the clinical app."""
+from django.dispatch import Signal
+
+# Sent with the ontology model (Morphology, Topography, Diagnosis or Drug) as sender and the ids of the rows whose
+# synonyms were created, updated or deleted. ids is None when the whole table was (re)loaded.
+synonyms_changed = Signal(providing_args=['ids'])
@@ -0,0 +1,55 @@
+"""Run the steps of a page assembly concurrently, following their dependencies."""
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+
+logger = logging.getLogger('django')
+
+
+class TaskGraph:
+    """Steps whose results feed other steps, run on a thread pool with the time each one took recorded.
+
+    A step starts as soon as the steps it depends on are done, so independent I/O (database queries, REDCap calls)
+    overlaps and the whole graph takes roughly as long as its slowest chain of steps.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.steps = OrderedDict()  # name -> (function, names of the steps whose results are its arguments)
+        self.timings = OrderedDict()  # name -> seconds
+
+    def add(self, name, function, *dependencies):
+        """Add a step, called with the results of its dependencies (added before it) as arguments."""
+        for dependency in dependencies:
+            if dependency not in self.steps:
+                raise ValueError('Unknown step {} required by {}'.format(dependency, name))
+        self.steps[name] = (function, dependencies)
+
+    def run(self):
+        """Run all the steps and return their results by name. The first exception raised by a step is re-raised."""
+        futures = {}
+        # The steps are submitted in the order they were added, so the dependencies of a step are always running or
+        # done when it gets a worker, and waiting for them cannot starve the pool.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for name, (function, dependencies) in self.steps.items():
+                futures[name] = executor.submit(self._run_step, name, function, [futures[d] for d in dependencies])
+            results = OrderedDict((name, future.result()) for name, future in futures.items())
+        logger.debug('Steps timings: ' + ', '.join('{} {:.3f}s'.format(name, t) for name, t in self.timings.items()))
+        return results
+
+    def _run_step(self, name, function, dependencies):
+        arguments = [future.result() for future in dependencies]
+        start = time.time()
+        try:
+            return function(*arguments)
+        finally:
+            self.timings[name] = time.time() - start
+            # Each worker thread has its own database connections
+            connections.close_all()
+
+    def server_timing(self):
+        """Value of a Server-Timing header with the step timings, to see them in the browser developer tools."""
+        return ', '.join('{};dur={:.1f}'.format(name, t * 1000) for name, t in self.timings.items())
@@ -1,9 +1,8 @@
 """Views for the clinical part."""
-# import time
-
+import json
 from datetime import datetime
 
-from aauh.redcap_utils import get_redcap_dictionary, get_redcap_records, labelize_redcap_data
+from aauh.redcap_utils import labelize_redcap_data
 
 from dal import autocomplete
 
@@ -13,14 +12,18 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
-from django.db.models import Q
-from django.http import HttpResponseRedirect, JsonResponse
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import Case as DbCase, CharField, Count, IntegerField, OuterRef, Subquery, Value, When
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponseBadRequest, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import reverse
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
+from genomic.access import get_access
 from genomic.forms import VcfForm
 from genomic.models import File, LabInfo, Variant
 
@@ -31,17 +34,36 @@ from .forms import CaseForm, PatientForm, TreatmentForm
 from .models import (
     Case,
     Diagnosis,
-    DiagnosisSynonym,
     Drug,
-    DrugSynonym,
     Morphology,
-    MorphologySynonym,
     Patient,
     Project,
     Topography,
-    TopographySynonym,
-    Treatment
+    Treatment,
+    get_treatment_summaries
 )
+from .ontology_utils import diagnosis_codes
+from .redcap_cache import get_cached_redcap_dictionary, get_cached_redcap_records
+from .search_index import get_search_index
+from .task_graph import TaskGraph
+
+# Upper bound on the number of rows the autocomplete querysets are built from
+MAX_AUTOCOMPLETE_RESULTS = 500
+
+# Upper bound on the page size of the list APIs
+MAX_LIST_API_LIMIT = 10000
+
+PATIENTS_PER_PAGE = 50
+
+# Values of the sort parameter of the patients list (prefixed with - for descending order) -> ordering
+PATIENTS_LIST_SORTS = {
+    'id': 'id',
+    'centre_patient_id': 'centre_patient_id',
+    'sex': 'sex',
+    'age': '-birthdate',
+    'diagnosis': 'primary_diagnosis_label',
+    'relapses': 'num_cases',
+}
 
 
 class PatientsListView(LoginRequiredMixin, View):
@@ -60,16 +82,43 @@ class PatientsListView(LoginRequiredMixin, View):
         return self.__render_patients_list(request, form)
 
     def __render_patients_list(self, request, form=None):
-        patients = Patient.objects.filter(centre=request.user.profile.centre).order_by('-id')
+        # Primary case of each patient and number of cases, as subqueries rather than one query per patient
+        primary_cases = Case.objects.filter(patient=OuterRef('pk')).order_by('diagnosis_date', 'id')
+        case_counts = Case.objects.filter(patient=OuterRef('pk')).order_by().values('patient').annotate(
+            count=Count('id')).values('count')
+        patients = get_access(request).accessible_patients().annotate(
+            primary_diagnosis_id=Subquery(primary_cases.values('diagnosis_id')[:1], output_field=IntegerField()),
+            primary_diagnosis_label=Subquery(primary_cases.values('diagnosis__label')[:1],
+                                             output_field=CharField()),
+            num_cases=Subquery(case_counts, output_field=IntegerField())
+        )
+
+        sort = request.GET.get('sort', '-id')
+        if sort.lstrip('-') not in PATIENTS_LIST_SORTS:
+            sort = '-id'
+        ordering = PATIENTS_LIST_SORTS[sort.lstrip('-')]
+        if sort.startswith('-'):
+            ordering = ordering[1:] if ordering.startswith('-') else '-' + ordering
+        patients = patients.order_by(ordering, '-id')
+
+        paginator = Paginator(patients, PATIENTS_PER_PAGE)
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except PageNotAnInteger:
+            page = paginator.page(1)
+        except EmptyPage:
+            page = paginator.page(paginator.num_pages)
+
         patients_list = list()
-        for patient in patients:
+        for patient in page:
             age = relativedelta(datetime.now(), patient.birthdate).years
 
-            primary_case = patient.case_set.order_by('diagnosis_date').first()
-
-            if primary_case:
-                diagnosis = primary_case.diagnosis
-                relapses = patient.case_set.all().count() - 1
+            if patient.num_cases:
+                diagnosis = patient.primary_diagnosis_label
+                if diagnosis is None and patient.primary_diagnosis_id is not None:
+                    # Label not materialized yet
+                    diagnosis = str(Diagnosis(id=patient.primary_diagnosis_id))
+                relapses = patient.num_cases - 1
             else:
                 diagnosis = None
                 relapses = None
@@ -91,7 +140,7 @@ class PatientsListView(LoginRequiredMixin, View):
         return render(
             request,
             'clinical/patients_list.html',
-            {'patients': patients_list, 'form': form}
+            {'patients': patients_list, 'page': page, 'sort': sort, 'form': form}
         )
 
 
@@ -134,7 +183,7 @@ class CasesListView(LoginRequiredMixin, View):
     """To see all the cases of the centre of the user."""
 
     def get(self, request):
-        cases = Case.objects.filter(patient__centre__id=request.user.profile.centre.id).order_by('-id')
+        cases = get_access(request).accessible_cases().order_by('-id')
 
         return render(request, 'clinical/cases_list.html', {'cases': cases})
 
@@ -205,57 +254,30 @@ class ReportView(LoginRequiredMixin, View):
 
     def get(self, request, patient_id):
         """To see the patient report."""
-        # prev_time = time.time()
         patient = get_accessible_patient(request, patient_id)
 
-        patient.age = None
-        # print('patient_retrieved: ' + str(time.time() - prev_time)); prev_time = time.time()
-
-        cases = Case.objects.filter(patient=patient).order_by('relapse_number')
-        # print('cases_retrieved: ' + str(time.time() - prev_time)); prev_time = time.time()
-
-        cases_with_treatment = []
-        first_case = None
-        current_case = None
-        for case in cases:
-            if not first_case:
-                first_case = case
-                patient.age = relativedelta(first_case.diagnosis_date, patient.birthdate).years
-
-            case.treatment_str = get_case_treatment_str(case)
-            case.variants = Variant.objects.filter(file__case=case, significance__gte=3)  # 3 should be likely_pathogenic
-            cases_with_treatment.append(case)
-            current_case = case
-
-        # print('current_case_retrieved: ' + str(time.time() - prev_time)); prev_time = time.time()
-
-        clinical_df = []
-        medications_df = []
-        blood_tests_df = []
-        side_effects_df = []
+        # The independent steps (database queries, REDCap calls) run concurrently, see TaskGraph
+        graph = TaskGraph()
+        graph.add('cases', lambda: list(Case.objects.filter(patient=patient).order_by('relapse_number')))
+        graph.add('treatments', get_treatment_summaries, 'cases')
+        graph.add('variants', get_significant_variants_by_case, 'cases')
 
         if request.user.profile.centre.id == 1:  # so AAUH user
-            clinical_df = get_redcap_records(
-                settings.API_CLINICAL_TOKEN, None, None, [''], [None], [current_case.project_case_id]
-            )
-            # print('redcap_clinical_data_retrieved: ' + str(time.time() - prev_time)); prev_time = time.time()
-
-            clinical_df = clinical_df.loc[clinical_df['redcap_event_name'] == 'case_arm_1']
-
-            clinical_dictionary_df = get_redcap_dictionary(settings.API_CLINICAL_TOKEN)
+            graph.add('redcap_records', get_report_redcap_records, 'cases')
+            graph.add('redcap_dictionary', lambda: get_cached_redcap_dictionary(settings.API_CLINICAL_TOKEN))
+            graph.add('clinical_data', split_report_clinical_data, 'redcap_records', 'redcap_dictionary')
 
-            # print('redcap_clinical_dict_retrieved: ' + str(time.time() - prev_time)); prev_time = time.time()
+        results = graph.run()
 
-            # removing the "FOO_complete" columns that do contain any meaningfull info
-            # and it's not even in the dictionary
-            data_col = [col for col in clinical_df if not col.endswith('_complete')]
-            clinical_df = labelize_redcap_data(clinical_df[data_col], clinical_dictionary_df)
-            medications_df = clinical_df.loc[clinical_df.redcap_repeat_instrument == 'medication'].dropna(axis=1, how='all')
-            side_effects_df = clinical_df.loc[clinical_df['redcap_repeat_instrument'] == 'side_effect'].dropna(axis=1, how='all')
-            blood_tests_df = clinical_df.loc[clinical_df['redcap_repeat_instrument'] == 'blood_test'].dropna(axis=1, how='all')
-            clinical_df = clinical_df.loc[pandas.isnull(clinical_df['redcap_repeat_instrument'])].dropna(axis=1, how='all')
+        cases = results['cases']
+        patient.age = relativedelta(cases[0].diagnosis_date, patient.birthdate).years if cases else None
+        for case in cases:
+            case.treatment_str = results['treatments'][case.id]
+            case.variants = results['variants'].get(case.id, [])
+        first_case = cases[0] if cases else None
+        current_case = cases[-1] if cases else None
 
-            # print('data_labelized: ' + str(time.time() - prev_time)); prev_time = time.time()
+        clinical_data = results.get('clinical_data') or {}
 
         instruments = (
             {'prefix': 'prog', 'label': 'Prognostic factors'},
@@ -270,19 +292,52 @@ class ReportView(LoginRequiredMixin, View):
             request,
             'clinical/report.html',
             {
-                'patient': patient, 'current_case': current_case, 'prev_cases': cases_with_treatment[:-1], 'first_case': first_case,
-                'clinical_data': clinical_df,
-                'clinical_dictionary': clinical_dictionary_df,
+                'patient': patient, 'current_case': current_case, 'prev_cases': cases[:-1], 'first_case': first_case,
+                'clinical_data': clinical_data.get('clinical', []),
+                'clinical_dictionary': results.get('redcap_dictionary', []),
                 'instruments': instruments,
-                'medications': medications_df,
-                'side_effects': side_effects_df,
-                'blood_tests': blood_tests_df
+                'medications': clinical_data.get('medications', []),
+                'side_effects': clinical_data.get('side_effects', []),
+                'blood_tests': clinical_data.get('blood_tests', [])
             }
         )
+        rendered['Server-Timing'] = graph.server_timing()
+        return rendered
 
-        # print('rendererd: ' + str(time.time() - prev_time)); prev_time = time.time()
 
-        return rendered
+def get_significant_variants_by_case(cases):
+    """Return the clinically significant variants of the cases, by case id, in one query."""
+    variants = {}
+    significant = Variant.searchSignificantVariantsByCases(cases)
+    for variant in significant.select_related('file', 'gene'):
+        variants.setdefault(variant.case_id, []).append(variant)
+    return variants
+
+
+def get_report_redcap_records(cases):
+    """REDCap clinical records of the current (last) case of the report."""
+    if not cases:
+        return None
+    return get_cached_redcap_records(settings.API_CLINICAL_TOKEN, None, None, [''], [None], [cases[-1].project_case_id])
+
+
+def split_report_clinical_data(clinical_df, clinical_dictionary_df):
+    """Labelize the REDCap clinical records and split them by repeating instrument."""
+    if clinical_df is None:
+        return None
+
+    clinical_df = clinical_df.loc[clinical_df['redcap_event_name'] == 'case_arm_1']
+
+    # removing the "FOO_complete" columns that do contain any meaningfull info
+    # and it's not even in the dictionary
+    data_col = [col for col in clinical_df if not col.endswith('_complete')]
+    clinical_df = labelize_redcap_data(clinical_df[data_col], clinical_dictionary_df)
+    return {
+        'medications': clinical_df.loc[clinical_df.redcap_repeat_instrument == 'medication'].dropna(axis=1, how='all'),
+        'side_effects': clinical_df.loc[clinical_df['redcap_repeat_instrument'] == 'side_effect'].dropna(axis=1, how='all'),
+        'blood_tests': clinical_df.loc[clinical_df['redcap_repeat_instrument'] == 'blood_test'].dropna(axis=1, how='all'),
+        'clinical': clinical_df.loc[pandas.isnull(clinical_df['redcap_repeat_instrument'])].dropna(axis=1, how='all'),
+    }
 
 
 class UpdateTreatmentsView(LoginRequiredMixin, View):
@@ -291,9 +346,9 @@ class UpdateTreatmentsView(LoginRequiredMixin, View):
     def get(self, request, case_id):
         case = get_accessible_case(request, case_id)
         files = File.objects.filter(case=case.id).order_by('-id')
-        treat_elements = Treatment.objects.filter(case=case.id).order_by('treat_instance')
+        treat_elements = Treatment.objects.filter(case=case.id).select_related('drug').order_by('treat_instance')
 
-        treatment_str = ', '.join(Drug.code_str(elem.code) for elem in treat_elements)
+        treatment_str = ', '.join(elem.drug.code_str() if elem.drug else 'Undefined' for elem in treat_elements)
 
         form_vcf = VcfForm(
             request.user, case, initial={'lab_info': LabInfo.objects.filter(centre=request.user.profile.centre).first()}
@@ -345,162 +400,170 @@ class TreatmentView(LoginRequiredMixin, View):
         return HttpResponseRedirect(reverse("update-treatments", kwargs={'case_id': case.id}))
 
 
-class MorphologyAutocomplete(LoginRequiredMixin, autocomplete.Select2QuerySetView):
-    raise_exception = True  # If there is no user logged in, show a 403 error
+class IndexedAutocompleteMixin(object):
+    """Answer the autocomplete requests from the in-memory search index of the ontology model (see search_index)."""
 
-    def get_refs(self):
-        match_start = MorphologySynonym.objects.filter(description__istartswith=self.q)
-        if match_start.count() > 0:
-            return match_start
-        return MorphologySynonym.objects.filter(description__icontains=self.q)
+    model = None
 
     def get_queryset(self):
-        refs = self.get_refs().all()
-        tops = []
-        for ref in refs:
-            top = ref.morphology
-            if top.id not in tops:
-                tops.append(top.id)
-        return Morphology.objects.filter(id__in=tops).order_by('id')
+        ids = get_search_index(self.model).search(self.q)[:MAX_AUTOCOMPLETE_RESULTS]
+        ranking = DbCase(*[When(id=row_id, then=Value(rank)) for rank, row_id in enumerate(ids)],
+                         default=Value(len(ids)), output_field=IntegerField())
+        return self.model.objects.filter(id__in=ids).order_by(ranking)
+
+    def get(self, request, *args, **kwargs):
+        self.q = request.GET.get('q', '')
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+
+        index = get_search_index(self.model)
+        ids = index.search(self.q)
+        start = (page - 1) * self.paginate_by
+        results = [{'id': str(row_id), 'text': index.label(row_id)} for row_id in ids[start:start + self.paginate_by]]
+        return JsonResponse({'results': results, 'pagination': {'more': len(ids) > start + self.paginate_by}})
+
+
+class MorphologyAutocomplete(LoginRequiredMixin, IndexedAutocompleteMixin, autocomplete.Select2QuerySetView):
+    raise_exception = True  # If there is no user logged in, show a 403 error
+    model = Morphology
 
 
-class TopographyAutocomplete(LoginRequiredMixin, autocomplete.Select2QuerySetView):
+class TopographyAutocomplete(LoginRequiredMixin, IndexedAutocompleteMixin, autocomplete.Select2QuerySetView):
     raise_exception = True
-
-    def get_refs(self):
-        match_start = TopographySynonym.objects.filter(description__istartswith=self.q)
-        if match_start.count() > 0:
-            return match_start
-        return TopographySynonym.objects.filter(description__icontains=self.q)
-
-    def get_queryset(self):
-        refs = self.get_refs().all()
-        tops = []
-        for ref in refs:
-            top = ref.topography
-            if top.id not in tops:
-                tops.append(top.id)
-        return Topography.objects.filter(id__in=tops).order_by('id')
+    model = Topography
 
 
-class DiagnosisAutocomplete(LoginRequiredMixin, autocomplete.Select2QuerySetView):
+class DiagnosisAutocomplete(LoginRequiredMixin, IndexedAutocompleteMixin, autocomplete.Select2QuerySetView):
     raise_exception = True
-
-    def get_refs(self):
-        match_start = DiagnosisSynonym.objects.filter(description__istartswith=self.q)
-        if match_start.count() > 0:
-            return match_start
-        return DiagnosisSynonym.objects.filter(Q(description__icontains=self.q) | Q(diagnosis__code__istartswith=self.q))
-
-    def get_queryset(self):
-        refs = self.get_refs().all()
-        diagnoses = []
-        for ref in refs:
-            diagnosis = ref.diagnosis
-            if diagnosis.id not in diagnoses:
-                diagnoses.append(diagnosis.id)
-        return Diagnosis.objects.filter(id__in=diagnoses).order_by('id')
+    model = Diagnosis
 
 
-class DrugAutocomplete(LoginRequiredMixin, autocomplete.Select2QuerySetView):
+class DrugAutocomplete(LoginRequiredMixin, IndexedAutocompleteMixin, autocomplete.Select2QuerySetView):
     raise_exception = True  # If there is no user logged in, show a 403 error
-
-    def get_refs(self):
-        match_start = DrugSynonym.objects.filter(description__istartswith=self.q)
-        if match_start.count() > 0:
-            return match_start
-        return DrugSynonym.objects.filter(description__icontains=self.q)
-
-    def get_queryset(self):
-        refs = self.get_refs().all()
-        tops = []
-        for ref in refs:
-            top = ref.drug
-            if top.id not in tops:
-                tops.append(top.id)
-        return Drug.objects.filter(id__in=tops)
+    model = Drug
 
 
 # Utils functions to make sure the object is accessible to the user
 def get_accessible_patient(request, patient_id):
     patient = Patient.objects.get(pk=patient_id)
-    if patient.centre != request.user.profile.centre:
+    if not get_access(request).can_access_patient(patient):
         raise PermissionDenied('The user does not have access to this patient')
     return patient
 
 
 def get_accessible_case(request, case_id):
-    case = Case.objects.get(pk=case_id)
-    if case.patient.centre.id != request.user.profile.centre.id:
+    case = Case.objects.select_related('patient').get(pk=case_id)
+    if not get_access(request).can_access_case(case):
         raise PermissionDenied('The user does not have access to this case')
     return case
 
 
 def get_case_treatment_str(case):
-    treat_elements = Treatment.objects.filter(case=case.id).order_by('treat_instance')
-
-    drug_lst = []
-    treat_lst = []
-    for elem in treat_elements:
-        drug_name = Drug.off_name_str(elem.drug)
-        if drug_name != 'Undefined':
-            drug_lst.append(drug_name)
-        treat_type = elem.treat_type
-        if treat_type not in ['cont', 'cycl', 'cond']:
-            if treat_type == 'allo':
-                treat_lst.append('Allotrans.')
-            elif treat_type == 'waw':
-                treat_lst.append('WAW')
-            elif treat_type == 'rad':
-                treat_lst.append('RT')
-            elif treat_type == 'auto':
-                treat_lst.append('Autotrans.')
-            elif treat_type == 'surg':
-                treat_lst.append('Surgery')
-            elif treat_type == 'exptr' and pandas.isnull(elem.drug):
-                treat_lst.append('Experimental')
-            else:
-                treat_lst.append('Other')
+    return get_treatment_summaries([case])[case.id]
+
+
+def stream_list_response(request, queryset, serialize, updated_field='updated_dt'):
+    """Stream the rows of a list API as a JSON list (or NDJSON with format=ndjson) instead of building it in memory.
+
+    Supported GET parameters:
+     - updated_since: only the rows whose updated_field is since this date/datetime (ISO 8601), for incremental
+       synchronization, rejected when updated_field is None,
+     - after and limit: cursor pagination on the ids, the cursor of the next page is sent in the X-Next-Cursor header.
+    """
+    updated_since = request.GET.get('updated_since')
+    if updated_since:
+        if updated_field is None:
+            return HttpResponseBadRequest('updated_since is not supported by this API')
+        try:
+            since = parse_datetime(updated_since) or parse_date(updated_since)
+        except ValueError:
+            # Well formed but invalid, e.g. 2020-13-45
+            since = None
+        if since is None:
+            return HttpResponseBadRequest('Malformed updated_since: ' + updated_since)
+        queryset = queryset.filter(**{updated_field + '__gte': since})
+
+    try:
+        after = int(request.GET.get('after', 0))
+        limit = int(request.GET['limit']) if 'limit' in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest('after and limit must be integers')
+    queryset = queryset.filter(id__gt=after).order_by('id')
+
+    next_cursor = None
+    if limit is not None:
+        limit = min(max(limit, 1), MAX_LIST_API_LIMIT)
+        # One row more than asked, to know if there is a next page
+        rows = list(queryset[:limit + 1])
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1].id
+    else:
+        rows = queryset.iterator()
 
-    drug_lst = sorted(list(set(drug_lst)))  # converting to the list to a set removes duplicates.
+    if request.GET.get('format') == 'ndjson':
+        content = (json.dumps(serialize(row), cls=DjangoJSONEncoder) + '\n' for row in rows)
+        response = StreamingHttpResponse(content, content_type='application/x-ndjson')
+    else:
+        response = StreamingHttpResponse(_stream_json_list(serialize(row) for row in rows), content_type='application/json')
 
-    treat_lst = sorted(list(set(treat_lst)))
+    if next_cursor is not None:
+        response['X-Next-Cursor'] = str(next_cursor)
+    return response
 
-    drug_and_treatment_lst = drug_lst + treat_lst
-    if len(drug_and_treatment_lst) == 0:
-        drug_and_treatment_str = '-'
-    else:
-        drug_and_treatment_str = ', '.join(drug_treat for drug_treat in drug_and_treatment_lst)
 
-    return drug_and_treatment_str
+def _stream_json_list(items):
+    yield '['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps(item, cls=DjangoJSONEncoder)
+        separator = ', '
+    yield ']'
 
 
 @method_decorator(csrf_exempt, name='dispatch')
 class PatientListEndpoint(View):
 
     def get(self, request, centre_id=-1):
-        if centre_id == -1:
-            patients = list(Patient.objects.all())
-        else:
-            patients = list(Patient.objects.filter(centre__id=centre_id).all())
-        response = [{'id': p.id, 'centre': p.centre.id, 'local id': p.centre_patient_id, 'sex': p.sex, 'birthdate': p.birthdate} for p in patients]
-        return JsonResponse(response, safe=False)  # safe=False because it's a list, not a dict
+        patients = Patient.objects.all()
+        if centre_id != -1:
+            patients = patients.filter(centre__id=centre_id)
+        return stream_list_response(request, patients, self._serialize)
+
+    @staticmethod
+    def _serialize(p):
+        return {'id': p.id, 'centre': p.centre_id, 'local id': p.centre_patient_id, 'sex': p.sex, 'birthdate': p.birthdate,
+                'updated': str(p.updated_dt)}
 
 
 @method_decorator(csrf_exempt, name='dispatch')
 class CaseListEndpoint(View):
 
     def get(self, request, project_id=-1):
-        if project_id == -1:
-            cases = list(Case.objects.all())
-        else:
-            cases = list(Case.objects.filter(project__id=project_id).all())
-        response = [{'id': c.id, 'centre': c.project.centre.id, 'project': c.project.id, 'local id': c.project_case_id,
-                     'patient': c.patient.centre_patient_id, 'created': str(c.created_dt),
-                     'morphology': str(c.morphology), 'topography': str(c.topography), 'diagnosis': str(c.diagnosis),
-                     'diagnosis_date': str(c.diagnosis_date), 'relapse': c.relapse_number,
-                     'num_files': File.objects.filter(case=c).count()} for c in cases]
-        return JsonResponse(response, safe=False)
+        file_counts = File.objects.filter(case=OuterRef('pk')).order_by().values('case').annotate(
+            count=Count('id')).values('count')
+        cases = Case.objects.select_related('project', 'patient', 'morphology', 'topography', 'diagnosis').annotate(
+            num_files=Subquery(file_counts, output_field=IntegerField())
+        )
+        if 'diagnosis' in request.GET:
+            # ICD-10 code, the cases diagnosed with any of its descendants are included
+            diagnosis_id = diagnosis_codes.resolve(request.GET['diagnosis'])
+            if diagnosis_id is None:
+                return HttpResponseBadRequest('Unknown diagnosis code ' + request.GET['diagnosis'])
+            cases = cases.filter(diagnosis__ancestor_links__ancestor_id=diagnosis_id)
+        if project_id != -1:
+            cases = cases.filter(project__id=project_id)
+        return stream_list_response(request, cases, self._serialize)
+
+    @staticmethod
+    def _serialize(c):
+        return {'id': c.id, 'centre': c.project.centre_id, 'project': c.project_id, 'local id': c.project_case_id,
+                'patient': c.patient.centre_patient_id, 'created': str(c.created_dt),
+                'morphology': str(c.morphology), 'topography': str(c.topography), 'diagnosis': str(c.diagnosis),
+                'diagnosis_date': str(c.diagnosis_date), 'relapse': c.relapse_number,
+                'num_files': c.num_files or 0, 'updated': str(c.updated_dt)}
 
 
 @method_decorator(csrf_exempt, name='dispatch')
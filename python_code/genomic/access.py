@@ -0,0 +1,79 @@
+"""Access rules to the patients, cases and files, as queryset filters and object checks.
+
+The groups and centre of the user are loaded once and kept by the resolver, which is itself kept on the request (see
+get_access), so that checking many objects or filtering several querysets costs no further query.
+
+    - patients and cases: the ones of the centre of the user, plus the cases shared with them (see CaseGrant)
+    - files: the ones uploaded by the user, by the users of their centre for the Centre Admins, and all of them for
+      the Researchers and Clinicians
+"""
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from clinical.models import Case, CaseGrant, Patient
+
+from .models import File
+
+# Groups of the users who can access all the files
+ALL_FILES_GROUPS = {'Researchers', 'Clinicians'}
+CENTRE_FILES_GROUP = 'Centre Admins'
+
+
+class AccessResolver:
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def groups(self):
+        return set(self.user.groups.values_list('name', flat=True))
+
+    @cached_property
+    def centre_id(self):
+        return self.user.profile.centre_id
+
+    @cached_property
+    def shared_case_ids(self):
+        return set(CaseGrant.active().filter(user_id=self.user.id).values_list('case_id', flat=True))
+
+    def patients_filter(self, prefix=''):
+        """Q object selecting the patients accessible to the user, prefix being the path to them from the model."""
+        return Q(**{prefix + 'centre_id': self.centre_id})
+
+    def cases_filter(self, prefix=''):
+        shared_cases = CaseGrant.active().filter(user_id=self.user.id).values('case_id')
+        return self.patients_filter(prefix + 'patient__') | Q(**{prefix + 'id__in': shared_cases})
+
+    def files_filter(self, prefix=''):
+        if self.groups & ALL_FILES_GROUPS:
+            return Q()
+        q = Q(**{prefix + 'uploader_id': self.user.id})
+        if CENTRE_FILES_GROUP in self.groups:
+            q |= Q(**{prefix + 'uploader__profile__centre_id': self.centre_id})
+        return q
+
+    def accessible_patients(self, queryset=None):
+        return (Patient.objects.all() if queryset is None else queryset).filter(self.patients_filter())
+
+    def accessible_cases(self, queryset=None):
+        return (Case.objects.all() if queryset is None else queryset).filter(self.cases_filter())
+
+    def accessible_files(self, queryset=None):
+        return (File.objects.all() if queryset is None else queryset).filter(self.files_filter())
+
+    def can_access_patient(self, patient):
+        return patient.centre_id == self.centre_id
+
+    def can_access_case(self, case):
+        return case.id in self.shared_case_ids or self.can_access_patient(case.patient)
+
+    def can_access_file(self, file):
+        if file.uploader_id == self.user.id or self.groups & ALL_FILES_GROUPS:
+            return True
+        return CENTRE_FILES_GROUP in self.groups and file.uploader.profile.centre_id == self.centre_id
+
+
+def get_access(request):
+    """Return the access resolver of the user of the request, created once per request."""
+    if not hasattr(request, '_access_resolver'):
+        request._access_resolver = AccessResolver(request.user)
+    return request._access_resolver
@@ -1,7 +1,31 @@
 from django.contrib import admin
 
-from .models import Pipeline, RefGenome, LabInfo
+from .file_purge import purge_files, purge_files_in_background
+from .models import ClassificationBatch, File, Pipeline, RefGenome, LabInfo
 
+
+class FileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'case', 'uploader', 'uploaded_dt', 'size')
+    actions = ['purge_selected']
+
+    def get_actions(self, request):
+        actions = super(FileAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def delete_model(self, request, obj):
+        purge_files([obj.pk])
+
+    def purge_selected(self, request, queryset):
+        """Delete the files in the background, the default delete action loads all their variants."""
+        file_ids = list(queryset.values_list('pk', flat=True))
+        purge_files_in_background(file_ids)
+        self.message_user(request, '{} files will be deleted in the background.'.format(len(file_ids)))
+    purge_selected.short_description = 'Delete selected files in the background'
+
+
+admin.site.register(ClassificationBatch)
+admin.site.register(File, FileAdmin)
 admin.site.register(Pipeline)
 admin.site.register(LabInfo)
-admin.site.register(RefGenome)
\ No newline at end of file
+admin.site.register(RefGenome)
@@ -0,0 +1,188 @@
+"""Resumable uploads of VCF files, sent in chunks rather than in one multipart request.
+
+The protocol, served by the ChunkedUpload* views:
+
+    POST api/uploads/                       name, size, sha256 (hex digest of the whole file) and optionally case_id,
+                                            labinfo, format and type -> {"upload_id", "offset", "chunk_size"}
+    PUT  api/uploads/<id>/?offset=<n>       raw bytes of the chunk starting at offset n -> {"offset"}
+    GET  api/uploads/<id>/                  -> {"offset", "size", "status"}, to resume an interrupted upload
+    POST api/uploads/<id>/finalize/         checks the size and checksum, and ingests the file if a case was given
+
+The chunks are copied from the request stream straight to a partial file of the vcf_files storage, which is linked to
+its final path when the file is ingested. Uploads finalized without a case are given to the batch upload by id.
+"""
+import logging
+import os
+import uuid
+
+from django.core.files.storage import default_storage
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from .models import ChunkedUpload, File
+from .validators import validate_file_extension
+from .vcf_utils import file_sha256, ingest_file
+
+logger = logging.getLogger('django')
+
+PARTIAL_DIR = os.path.join('vcf_files', 'partial')
+
+# Size of the chunks suggested to the clients, and largest chunk accepted
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Size of the reads from the request stream
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class ChunkedUploadError(Exception):
+    pass
+
+
+class OffsetMismatch(ChunkedUploadError):
+    """The chunk does not start where the previous one ended."""
+
+    def __init__(self, offset):
+        super(OffsetMismatch, self).__init__('The upload is at offset {}'.format(offset))
+        self.offset = offset
+
+
+def partial_path(upload):
+    return default_storage.path(os.path.join(PARTIAL_DIR, upload.token + '.part'))
+
+
+def start_upload(uploader, name, size, sha256, **file_fields):
+    """Create an upload, file_fields being the case, lab_info, format and type of the File to create."""
+    if size < 0:
+        raise ChunkedUploadError('Invalid size: {}'.format(size))
+    # Only the base name is kept, the file is stored under the directory of its case
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    max_length = File._meta.get_field('name').max_length
+    if name in ('', '.', '..') or len(name) > max_length:
+        raise ChunkedUploadError('Invalid file name, it must have 1 to {} characters'.format(max_length))
+    upload = ChunkedUpload(token=uuid.uuid4().hex, uploader=uploader, name=name, size=size, sha256=sha256.lower(),
+                           **file_fields)
+    validate_file_extension(upload)
+    upload.save()
+    path = partial_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return upload
+
+
+def write_chunk(upload, offset, stream, length):
+    """Copy length bytes of stream to the upload at offset, and return the new offset of the upload."""
+    if upload.status != 'uploading':
+        raise ChunkedUploadError('The upload is {}'.format(upload.status))
+    if offset != upload.offset:
+        raise OffsetMismatch(upload.offset)
+    if length > MAX_CHUNK_SIZE or offset + length > upload.size:
+        raise ChunkedUploadError('Chunks are at most {} bytes and cannot go past the size of the file'
+                                 .format(MAX_CHUNK_SIZE))
+
+    written = 0
+    with open(partial_path(upload), 'r+b') as partial:
+        partial.seek(offset)
+        while written < length:
+            data = stream.read(min(COPY_BUFFER_SIZE, length - written))
+            if not data:
+                break
+            partial.write(data)
+            written += len(data)
+        # Drops whatever an interrupted attempt at this chunk wrote past it
+        partial.truncate()
+
+    # Only advances if no other request wrote a chunk meanwhile
+    if not ChunkedUpload.objects.filter(pk=upload.pk, offset=offset).update(offset=offset + written,
+                                                                            updated_dt=timezone.now()):
+        upload.refresh_from_db()
+        raise OffsetMismatch(upload.offset)
+    upload.offset = offset + written
+    if written < length:
+        raise ChunkedUploadError('Received {} of the {} bytes of the chunk'.format(written, length))
+    return upload.offset
+
+
+def complete_upload(upload):
+    """Check that the whole file was received and matches its checksum."""
+    if upload.status != 'uploading':
+        return
+    if upload.offset != upload.size:
+        raise ChunkedUploadError('Received {} of the {} bytes of the file'.format(upload.offset, upload.size))
+    sha256 = file_sha256(partial_path(upload))
+    if sha256 != upload.sha256:
+        # Nothing tells which chunk is corrupted, the file has to be sent again
+        ChunkedUpload.objects.filter(pk=upload.pk).update(offset=0)
+        upload.offset = 0
+        open(partial_path(upload), 'wb').close()
+        logger.warning('Checksum mismatch for the upload {} of {}'.format(upload.token, upload.name))
+        raise ChunkedUploadError('Checksum mismatch: received a file with SHA-256 {}'.format(sha256))
+    upload.status = 'complete'
+    upload.save(update_fields=['status', 'updated_dt'])
+
+
+def create_file_from_upload(upload, case, lab_info, format, type):
+    """Link a complete upload to the vcf_files of the case and return its File, to be called in a transaction."""
+    if upload.status != 'complete':
+        raise ChunkedUploadError('The upload is {}'.format(upload.status))
+    file_obj = File(case=case, uploader=upload.uploader, lab_info=lab_info, format=format, type=type,
+                    uploaded_dt=timezone.now(), size=upload.size, name=upload.name, sha256=upload.sha256)
+    name = default_storage.get_available_name(File._meta.get_field('file').generate_filename(file_obj, upload.name))
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Linked rather than moved, the partial file is only removed once the File is committed so that the upload can be
+    # ingested again if the transaction is rolled back
+    os.link(partial_path(upload), path)
+    transaction.on_commit(lambda: os.remove(partial_path(upload)))
+
+    file_obj.file.name = name
+    file_obj.save()
+    upload.file = file_obj
+    upload.status = 'ingested'
+    upload.save(update_fields=['file', 'status', 'updated_dt'])
+    return file_obj
+
+
+def ingest_upload(upload):
+    """Create the File of a complete upload started for a case and save its variants, in one transaction.
+
+    If the file cannot be ingested, the transaction is rolled back, the stored file removed and a ChunkedUploadError
+    raised, the upload staying complete.
+    """
+    file_obj = None
+    try:
+        with transaction.atomic():
+            file_obj = create_file_from_upload(upload, upload.case, upload.lab_info, upload.format, upload.type)
+            ingest_file(file_obj)
+    except Exception as e:
+        if file_obj is not None and os.path.isfile(file_obj.file.path):
+            os.remove(file_obj.file.path)
+        upload.status = 'complete'
+        upload.file = None
+        if isinstance(e, (ChunkedUploadError, DatabaseError)):
+            raise
+        logger.exception('Could not ingest the upload {} of {}'.format(upload.token, upload.name))
+        raise ChunkedUploadError('Could not ingest the file: {}'.format(e))
+    return file_obj
+
+
+def consume_duplicate_upload(upload, file_obj):
+    """Mark a complete upload with the same content as file_obj as ingested into it, its partial file is removed."""
+    if upload.status != 'complete':
+        raise ChunkedUploadError('The upload is {}'.format(upload.status))
+    upload.file = file_obj
+    upload.status = 'ingested'
+    upload.save(update_fields=['file', 'status', 'updated_dt'])
+    transaction.on_commit(lambda: os.remove(partial_path(upload)))
+
+
+def delete_stale_uploads(max_age):
+    """Delete the uploads not ingested and not written to for max_age (a timedelta), returns how many."""
+    stale = ChunkedUpload.objects.exclude(status='ingested').filter(updated_dt__lt=timezone.now() - max_age)
+    count = 0
+    for upload in stale:
+        if os.path.exists(partial_path(upload)):
+            os.remove(partial_path(upload))
+        upload.delete()
+        count += 1
+    return count
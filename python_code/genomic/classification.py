@@ -0,0 +1,114 @@
+"""Classification of variants (significance and checked state) by rules, with set-based updates and an audit trail.
+
+A rule selects the variants with the same values for its fields, e.g. {"gene": "KRAS", "position": 25398284,
+"ref": "C", "alt": "T"} for a hotspot across all the cases, or {"variant_ids": [...]} for an explicit list.
+Each classification creates a ClassificationBatch, and a VariantClassification with the previous values of every
+variant it changes, both inserted by one INSERT ... SELECT before the variants are updated by one UPDATE.
+"""
+import json
+
+from clinical.models import Case
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import SIGNIFICANCES, ClassificationBatch, Variant, VariantClassification
+from .signals import variants_classified
+
+# Rule field -> lookup on Variant
+RULE_FIELDS = {
+    'variant_ids': 'id__in',
+    'case_ids': 'case_id__in',
+    'gene': 'gene__name',
+    'chromosome': 'chromosome',
+    'position': 'position',
+    'ref': 'ref',
+    'alt': 'alt',
+    'dbsnp_id': 'dbsnp_id',
+    'cosmic_id': 'cosmic_id',
+}
+
+# Largest list of ids in a rule, SQL Server accepts at most 2100 parameters per query
+MAX_RULE_IDS = 1000
+
+BATCH_SIZE = 500
+
+
+def variants_matching(rule):
+    """Return the variants selected by a rule."""
+    if not rule:
+        raise ValueError('A rule needs at least one field')
+    unknown = set(rule) - set(RULE_FIELDS)
+    if unknown:
+        raise ValueError('Unknown rule fields: {}'.format(', '.join(sorted(unknown))))
+    for field in ('variant_ids', 'case_ids'):
+        if field in rule and (not isinstance(rule[field], list) or len(rule[field]) > MAX_RULE_IDS):
+            raise ValueError('{} must be a list of at most {} ids'.format(field, MAX_RULE_IDS))
+    return Variant.objects.filter(**{RULE_FIELDS[field]: value for field, value in rule.items()})
+
+
+def parse_significance(value):
+    """Significance key from its key or name (e.g. 4 or "Pathogenic"), None stays None."""
+    if value is None:
+        return None
+    if isinstance(value, int) and not isinstance(value, bool) and value in dict(SIGNIFICANCES):
+        return value
+    key = Variant.getSignificanceKey(value) if isinstance(value, str) else None
+    if key is None:
+        raise ValueError('Unknown significance: {}'.format(value))
+    return key
+
+
+def parse_checked(value):
+    """Checked state from a boolean or 0/1, None stays None."""
+    if value is None:
+        return None
+    if value in (True, False, 0, 1) and not isinstance(value, (str, float)):
+        return int(value)
+    raise ValueError('Invalid checked state: {}, expected a boolean or 0/1'.format(value))
+
+
+def classify_variants(user, rule, significance=None, checked=None, comment=''):
+    """Set the significance and/or checked state of the variants selected by rule, returns the batch and the number
+    of variants changed (the ones already classified this way are left out)."""
+    significance = parse_significance(significance)
+    checked = parse_checked(checked)
+    if significance is None and checked is None:
+        raise ValueError('Nothing to classify, give a significance or a checked state')
+
+    changed = Q()
+    updates = {}
+    if significance is not None:
+        changed |= ~Q(significance=significance)
+        updates['significance'] = significance
+    if checked is not None:
+        changed |= ~Q(checked=checked)
+        updates['checked'] = checked
+    selection = variants_matching(rule).filter(changed)
+
+    with transaction.atomic():
+        batch = ClassificationBatch.objects.create(user=user, rule=json.dumps(rule, sort_keys=True),
+                                                   significance=significance, checked=checked, comment=comment or '')
+        selection_sql, selection_params = selection.values('id').query.sql_with_params()
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {audit} (batch_id, variant_id, previous_significance, previous_checked) '
+                'SELECT %s, id, significance, checked FROM {variant} WHERE id IN ({selection})'.format(
+                    audit=quote(VariantClassification._meta.db_table), variant=quote(Variant._meta.db_table),
+                    selection=selection_sql),
+                [batch.id] + list(selection_params))
+            count = cursor.rowcount
+
+        classified = Variant.objects.filter(variantclassification__batch=batch)
+        classified.update(**updates)
+
+        # The incremental case lists (updated_since) report the cases again
+        case_ids = sorted(set(classified.exclude(case=None).values_list('case_id', flat=True)))
+        now = timezone.now()
+        for start in range(0, len(case_ids), BATCH_SIZE):
+            Case.objects.filter(id__in=case_ids[start:start + BATCH_SIZE]).update(updated_dt=now)
+
+        transaction.on_commit(
+            lambda: variants_classified.send(sender=ClassificationBatch, batch=batch, case_ids=case_ids))
+    return batch, count
@@ -0,0 +1,90 @@
+"""Deletion of VCF files and everything depending on them with set-based SQL.
+
+Deleting a File through the ORM makes the collector load every variant, annotation and transcript link in memory, and
+delete them by chunks of ids. Here each dependent table is emptied with one DELETE (or UPDATE for SET_NULL relations)
+per chunk of files, selecting its rows with nested subqueries on the file ids, the deepest tables first. The dependent
+tables are found from the model relations, so new models referencing File or Variant are purged as well.
+
+No delete signal is sent, the stored files are removed once the transaction is committed.
+"""
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import connection, connections, models, transaction
+
+from .models import File
+
+logger = logging.getLogger('django')
+
+# Number of files per statement
+PURGE_BATCH_SIZE = 500
+
+
+def _dependents(model):
+    """Relations of the models (auto-created M2M tables included) with a foreign key to model."""
+    return [relation for relation in model._meta.get_fields(include_hidden=True)
+            if relation.one_to_many and relation.auto_created and not relation.concrete]
+
+
+def _purge_dependents(cursor, model, selection, params):
+    """Delete or unlink the rows depending on the rows of model whose primary key is selected by selection."""
+    quote = connection.ops.quote_name
+    for relation in _dependents(model):
+        related = relation.related_model
+        table = quote(related._meta.db_table)
+        column = quote(relation.field.column)
+        if relation.on_delete == models.CASCADE:
+            related_selection = 'SELECT {pk} FROM {table} WHERE {column} IN ({selection})'.format(
+                pk=quote(related._meta.pk.column), table=table, column=column, selection=selection)
+            _purge_dependents(cursor, related, related_selection, params)
+            cursor.execute('DELETE FROM {table} WHERE {column} IN ({selection})'.format(
+                table=table, column=column, selection=selection), params)
+        elif relation.on_delete == models.SET_NULL:
+            cursor.execute('UPDATE {table} SET {column} = NULL WHERE {column} IN ({selection})'.format(
+                table=table, column=column, selection=selection), params)
+        elif relation.on_delete != models.DO_NOTHING:
+            raise ValueError('Cannot purge {} rows referencing {}'.format(related.__name__, model.__name__))
+
+
+def purge_files(file_ids):
+    """Delete the files with their variants, annotations etc. and return how many were deleted."""
+    file_ids = list(file_ids)
+    quote = connection.ops.quote_name
+    count = 0
+    with transaction.atomic():
+        for start in range(0, len(file_ids), PURGE_BATCH_SIZE):
+            ids = file_ids[start:start + PURGE_BATCH_SIZE]
+            paths = [os.path.join(settings.MEDIA_ROOT, name)
+                     for name in File.objects.filter(pk__in=ids).values_list('file', flat=True) if name]
+            placeholders = ', '.join(['%s'] * len(ids))
+            with connection.cursor() as cursor:
+                _purge_dependents(cursor, File, placeholders, ids)
+                cursor.execute('DELETE FROM {table} WHERE {pk} IN ({ids})'.format(
+                    table=quote(File._meta.db_table), pk=quote(File._meta.pk.column), ids=placeholders), ids)
+                count += cursor.rowcount
+            transaction.on_commit(lambda paths=paths: _remove_stored_files(paths))
+    return count
+
+
+def _remove_stored_files(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def purge_files_in_background(file_ids):
+    """Purge the files in another thread, once the current transaction (if any) is committed."""
+    file_ids = list(file_ids)
+
+    def run():
+        try:
+            count = purge_files(file_ids)
+            logger.info('Purged {} VCF files'.format(count))
+        except Exception:
+            logger.exception('Could not purge the VCF files {}'.format(file_ids))
+        finally:
+            connections.close_all()
+
+    transaction.on_commit(lambda: threading.Thread(target=run, daemon=True).start())
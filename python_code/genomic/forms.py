@@ -1,6 +1,7 @@
 from django import forms
 
 from .models import File, CHROMOSOMES
+from .vcf_utils import uploaded_file_sha256
 
 
 class VcfForm(forms.ModelForm):
@@ -19,6 +20,7 @@ class VcfForm(forms.ModelForm):
         vcf_file.uploader = self.user
         vcf_file.case = self.case
         vcf_file.name = vcf_file.file.name
+        vcf_file.sha256 = uploaded_file_sha256(vcf_file.file)
         if commit:
             vcf_file.save()
         return vcf_file
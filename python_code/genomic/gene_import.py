@@ -0,0 +1,260 @@
+"""Import of the gene and transcript models of a reference genome from GTF, GFF3 or BED exports.
+
+The file is read line by line, each feature becoming a transcript of a gene:
+
+    - GTF (Ensembl, GENCODE, RefSeq): the transcript features, their gene being their gene_id (named by gene_name)
+    - GFF3 (Ensembl, RefSeq): the mRNA/transcript-like features, their gene being their Parent (named by its Name)
+    - BED (RefSeq/Ensembl transcripts, e.g. UCSC bigGenePred): one transcript per line named by the 4th column, the gene
+      name being read from the 13th column (name2) when there is one and the transcript name otherwise. BED files have
+      no gene ids, the overlapping transcripts of the same gene name form a gene identified by its name and start.
+
+Gene names are only labels: Ensembl and GENCODE reuse names such as Y_RNA or U6 for hundreds of loci, which stay
+separate genes. Coordinates are stored 1-based and inclusive as the variant positions, BED ones being shifted. The
+extent of a gene is the union of its transcripts. Genes are matched on (accession, chromosome), or on their name for
+the genes created before the accessions were stored, and transcripts on (isoform, gene). The new ones are bulk created
+and the moved ones updated, so importing a newer release of the same annotation is incremental.
+"""
+import gzip
+import logging
+import re
+from urllib.parse import unquote
+
+from django.db import transaction
+
+from .models import CHROMOSOMES, Gene, Transcript
+
+logger = logging.getLogger('django')
+
+FORMATS = ('gtf', 'gff3', 'bed')
+
+# GFF3 feature types of the transcripts
+GFF3_TRANSCRIPT_TYPES = {'mRNA', 'transcript', 'ncRNA', 'lnc_RNA', 'miRNA', 'snRNA', 'snoRNA', 'rRNA', 'tRNA',
+                         'primary_transcript', 'V_gene_segment', 'C_gene_segment'}
+
+BED_GENE_COLUMN = 12
+
+CHROMOSOME_NAMES = dict(CHROMOSOMES)
+CHROMOSOME_CODES_BY_NAME = dict((name, code) for code, name in CHROMOSOMES)
+CHROMOSOME_CODES_BY_NAME['MT'] = 25
+
+CHROMOSOME_PATTERN = re.compile(r'^(?:chr)?([0-9]{1,2}|[XYM]|MT)$', re.IGNORECASE)
+
+
+class GeneImportError(Exception):
+    pass
+
+
+def guess_format(path):
+    """Format of a file from its extension, gzipped files included."""
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    for fmt in FORMATS:
+        if name.endswith('.' + fmt) or (fmt == 'gff3' and name.endswith('.gff')):
+            return fmt
+    raise GeneImportError('Unknown gene model format of {}, expected one of {}'.format(path, ', '.join(FORMATS)))
+
+
+def open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+
+def parse_chromosome(name):
+    """Chromosome code of a sequence name (1, chr1, X, chrM, MT...), None for the other sequences (contigs, patches)."""
+    match = CHROMOSOME_PATTERN.match(name)
+    if match is None:
+        return None
+    name = match.group(1).upper()
+    return CHROMOSOME_CODES_BY_NAME.get(name.zfill(2) if name.isdigit() else name)
+
+
+def parse_gtf_attributes(attributes):
+    """Attributes of a GTF line, the first value being kept for the repeated keys (tag, ont...)."""
+    parsed = {}
+    for attribute in attributes.split(';'):
+        key, _, value = attribute.strip().partition(' ')
+        if key and key not in parsed:
+            parsed[key] = value.strip('"')
+    return parsed
+
+
+def parse_gff3_attributes(attributes):
+    parsed = {}
+    for attribute in attributes.split(';'):
+        key, _, value = attribute.partition('=')
+        if key:
+            parsed[key.strip()] = unquote(value)
+    return parsed
+
+
+def read_gtf(lines):
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        columns = line.rstrip('\n').split('\t')
+        if len(columns) < 9 or columns[2] != 'transcript':
+            continue
+        attributes = parse_gtf_attributes(columns[8])
+        accession = attributes.get('gene_id')
+        isoform = attributes.get('transcript_id')
+        if accession and isoform:
+            yield (columns[0], int(columns[3]), int(columns[4]), accession, attributes.get('gene_name') or accession,
+                   isoform)
+
+
+def read_gff3(lines):
+    # Gene names by ID, the genes coming before their transcripts in GFF3 files
+    genes = {}
+    for line in lines:
+        if line.startswith('##FASTA'):
+            break
+        if line.startswith('#'):
+            continue
+        columns = line.rstrip('\n').split('\t')
+        if len(columns) < 9:
+            continue
+        attributes = parse_gff3_attributes(columns[8])
+        if columns[2] in ('gene', 'pseudogene', 'ncRNA_gene') and 'ID' in attributes:
+            genes[attributes['ID']] = attributes.get('Name') or attributes['ID']
+        elif columns[2] in GFF3_TRANSCRIPT_TYPES and 'Parent' in attributes:
+            parent = attributes['Parent'].split(',')[0]
+            isoform = attributes.get('transcript_id') or attributes.get('Name') or attributes.get('ID')
+            if isoform:
+                yield columns[0], int(columns[3]), int(columns[4]), parent, genes.get(parent, parent), isoform
+
+
+def read_bed(lines):
+    for line in lines:
+        if line.startswith(('#', 'track', 'browser')) or not line.strip():
+            continue
+        columns = line.rstrip('\n').split('\t')
+        if len(columns) < 4:
+            continue
+        isoform = columns[3]
+        gene = columns[BED_GENE_COLUMN] if len(columns) > BED_GENE_COLUMN and columns[BED_GENE_COLUMN] else isoform
+        # BED intervals are 0-based and half-open, and there is no gene id
+        yield columns[0], int(columns[1]) + 1, int(columns[2]), None, gene, isoform
+
+
+READERS = {'gtf': read_gtf, 'gff3': read_gff3, 'bed': read_bed}
+
+
+def read_gene_models(lines, fmt):
+    """Read the genes and transcripts of a gene model file.
+
+    Returns ({(accession, chromosome): [name, start, end]}, {(accession, chromosome, isoform): (start, end)}), the
+    transcripts on the other sequences being skipped.
+    """
+    # (accession, gene name, chromosome, isoform, start, end) of the transcripts, the accession being None in BED files
+    rows = []
+    skipped = 0
+    for sequence, start, end, accession, name, isoform in READERS[fmt](lines):
+        chromosome = parse_chromosome(sequence)
+        if chromosome is None:
+            skipped += 1
+            continue
+        rows.append((accession, name, chromosome, isoform, start, end))
+    if skipped:
+        logger.info('Skipped {} transcripts on unknown sequences'.format(skipped))
+
+    name_length = Gene._meta.get_field('name').max_length
+    genes = {}
+    transcripts = {}
+    for accession, name, chromosome, isoform, start, end in locate_unidentified_genes(rows):
+        gene_key = (accession, chromosome)
+        gene = genes.get(gene_key)
+        if gene is None:
+            genes[gene_key] = [name[:name_length], start, end]
+        else:
+            gene[1] = min(gene[1], start)
+            gene[2] = max(gene[2], end)
+        transcripts[gene_key + (isoform,)] = (start, end)
+    return genes, transcripts
+
+
+def locate_unidentified_genes(rows):
+    """Give the transcripts without accession the one of their locus, named name:start.
+
+    The loci are the overlapping transcripts of the same gene name and chromosome.
+    """
+    loci = {}
+    for row in sorted((row for row in rows if row[0] is None), key=lambda row: (row[1], row[2], row[4])):
+        accession, name, chromosome, isoform, start, end = row
+        locus = loci.get((name, chromosome))
+        if locus is None or start > locus[1]:
+            locus = loci[(name, chromosome)] = ['{}:{}'.format(name, start), end]
+        locus[1] = max(locus[1], end)
+        yield (locus[0],) + row[1:]
+    for row in rows:
+        if row[0] is not None:
+            yield row
+
+
+def import_gene_models(path, ref_genome, fmt=None, batch_size=500):
+    """Import the genes and transcripts of a GTF/GFF3/BED file for ref_genome, returns the numbers of new ones."""
+    fmt = fmt or guess_format(path)
+    with open_text(path) as lines:
+        genes, transcripts = read_gene_models(lines, fmt)
+
+    with transaction.atomic():
+        gene_count = save_genes(ref_genome, genes, batch_size)
+        gene_ids = {(accession, chromosome): gene_id for gene_id, accession, chromosome
+                    in Gene.objects.filter(ref_genome=ref_genome).values_list('id', 'accession', 'chromosome')}
+        transcript_count = save_transcripts(ref_genome, transcripts, gene_ids, batch_size)
+
+    logger.info('Imported {} new genes and {} new transcripts of {} from {}'.format(
+        gene_count, transcript_count, ref_genome.name, path))
+    return gene_count, transcript_count
+
+
+def save_genes(ref_genome, genes, batch_size=500):
+    """Create the new genes and update the moved ones, returns the number of genes created.
+
+    The genes created before the accessions were stored (accession NULL) are matched on their name and chromosome,
+    and an overlapping extent, and are given their accession.
+    """
+    existing = {}
+    legacy = {}  # (name, chromosome) -> [(id, start, end)] of the genes without accession
+    for gene_id, accession, chromosome, name, start, end in Gene.objects.filter(ref_genome=ref_genome).values_list(
+            'id', 'accession', 'chromosome', 'name', 'start_position', 'end_position'):
+        if accession is None:
+            legacy.setdefault((name, chromosome), []).append((gene_id, start, end))
+        else:
+            existing[(accession, chromosome)] = (gene_id, name, start, end)
+
+    new_genes = []
+    for key, (name, start, end) in genes.items():
+        if key in existing:
+            if existing[key][1:] != (name, start, end):
+                Gene.objects.filter(pk=existing[key][0]).update(name=name, start_position=start, end_position=end)
+            continue
+        candidates = legacy.get((name, key[1]), [])
+        match = next((gene for gene in candidates if gene[1] <= end and gene[2] >= start), None)
+        if match is not None:
+            candidates.remove(match)
+            Gene.objects.filter(pk=match[0]).update(accession=key[0], start_position=start, end_position=end)
+        else:
+            new_genes.append(Gene(accession=key[0], chromosome=key[1], name=name, ref_genome=ref_genome,
+                                  start_position=start, end_position=end))
+    Gene.objects.bulk_create(new_genes, batch_size=batch_size)
+    return len(new_genes)
+
+
+def save_transcripts(ref_genome, transcripts, gene_ids, batch_size=500):
+    existing = {(gene_id, isoform): (transcript_id, start, end) for transcript_id, gene_id, isoform, start, end
+                in Transcript.objects.filter(producing_gene__ref_genome=ref_genome)
+                .values_list('id', 'producing_gene_id', 'isoform', 'start_position', 'end_position')}
+    new_transcripts = []
+    for (accession, chromosome, isoform), (start, end) in transcripts.items():
+        key = (gene_ids[(accession, chromosome)], isoform)
+        if key not in existing:
+            new_transcripts.append(Transcript(
+                isoform=isoform, producing_gene_id=key[0], start_position=start, end_position=end,
+                reference_sequence=getattr(ref_genome, 'chr' + CHROMOSOME_NAMES[chromosome])
+            ))
+        elif existing[key][1:] != (start, end):
+            Transcript.objects.filter(pk=existing[key][0]).update(start_position=start, end_position=end)
+    Transcript.objects.bulk_create(new_transcripts, batch_size=batch_size)
+    return len(new_transcripts)
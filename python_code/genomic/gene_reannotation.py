@@ -0,0 +1,121 @@
+"""Re-assignment of the genes of the ingested variants, after new gene models were imported (see gene_import).
+
+The variants of a reference genome are swept one chromosome at a time in position order, by pages on (position, id),
+and merge-joined with the genes of the chromosome sorted by start: the genes starting at or before the current position
+join the active ones, which are dropped once they end before it. As at ingest (vcf_utils.GeneIntervals), a variant gets
+the first active gene by start containing it, and NULL if there is none.
+
+Only the variants whose gene changes are updated, with one CASE WHEN UPDATE per batch. The last variant swept is stored
+in a GeneAssignmentCheckpoint after each page, so an interrupted sweep resumes where it stopped. The chromosomes are
+independent and can be swept in parallel, see reannotate_genes.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import CHROMOSOMES, Gene, GeneAssignmentCheckpoint, Variant
+
+logger = logging.getLogger('django')
+
+# Variants read per page, and updated per statement
+PAGE_SIZE = 10000
+UPDATE_BATCH_SIZE = 500
+
+
+class GeneSweep:
+    """Merge-join of increasing positions with the genes of a chromosome sorted by start."""
+
+    def __init__(self, genes):
+        self.genes = genes  # (start, end, id) sorted by start
+        self.next = 0
+        self.active = []  # (start, end, id) of the genes started, in start order
+
+    def find(self, position):
+        """Id of the first gene (by start) containing the position, the positions being given in increasing order."""
+        while self.next < len(self.genes) and self.genes[self.next][0] <= position:
+            self.active.append(self.genes[self.next])
+            self.next += 1
+        self.active = [gene for gene in self.active if gene[1] >= position]
+        return self.active[0][2] if self.active else None
+
+
+def update_genes(changes):
+    """Set the gene of the variants of changes ({variant id: gene id or None}) with batched CASE WHEN updates."""
+    changes = list(changes.items())
+    for start in range(0, len(changes), UPDATE_BATCH_SIZE):
+        batch = changes[start:start + UPDATE_BATCH_SIZE]
+        Variant.objects.filter(id__in=[variant_id for variant_id, _ in batch]).update(gene_id=models.Case(
+            *[models.When(id=variant_id, then=models.Value(gene_id, output_field=models.IntegerField()))
+              for variant_id, gene_id in batch],
+            output_field=models.IntegerField()
+        ))
+
+
+def reannotate_chromosome(ref_genome_id, chromosome, restart=False):
+    """Sweep the variants of a chromosome of a reference genome, returns the number of variants whose gene changed."""
+    checkpoint, _ = GeneAssignmentCheckpoint.objects.get_or_create(ref_genome_id=ref_genome_id, chromosome=chromosome)
+    if restart or checkpoint.finished_dt is not None:
+        checkpoint.last_position = checkpoint.last_variant_id = checkpoint.finished_dt = None
+        checkpoint.started_dt = timezone.now()
+        checkpoint.save()
+
+    genes = list(Gene.objects.filter(ref_genome_id=ref_genome_id, chromosome=chromosome)
+                 .order_by('start_position', 'id').values_list('start_position', 'end_position', 'id'))
+    sweep = GeneSweep(genes)
+    variants = Variant.objects.filter(file__lab_info__pipeline__ref_genome_id=ref_genome_id, chromosome=chromosome)
+    if checkpoint.last_position is not None:
+        # Brings the active genes to where the sweep stopped
+        sweep.find(checkpoint.last_position)
+
+    changed = 0
+    while True:
+        page = variants
+        if checkpoint.last_position is not None:
+            # The redundant position__gte lets the (chromosome, position) index seek to the checkpoint, the OR alone
+            # cannot be used to seek
+            page = page.filter(Q(position__gt=checkpoint.last_position) |
+                               Q(position=checkpoint.last_position, id__gt=checkpoint.last_variant_id),
+                               position__gte=checkpoint.last_position)
+        rows = list(page.order_by('position', 'id').values_list('id', 'position', 'gene_id')[:PAGE_SIZE])
+        if not rows:
+            break
+
+        changes = {}
+        for variant_id, position, gene_id in rows:
+            new_gene_id = sweep.find(position)
+            if new_gene_id != gene_id:
+                changes[variant_id] = new_gene_id
+        with transaction.atomic():
+            update_genes(changes)
+            checkpoint.last_variant_id, checkpoint.last_position = rows[-1][0], rows[-1][1]
+            checkpoint.save(update_fields=['last_position', 'last_variant_id', 'updated_dt'])
+        changed += len(changes)
+
+    checkpoint.finished_dt = timezone.now()
+    checkpoint.save(update_fields=['finished_dt', 'updated_dt'])
+    logger.info('Genes of the variants of chromosome {} of the reference genome {} re-assigned, {} changed'.format(
+        chromosome, ref_genome_id, changed))
+    return changed
+
+
+def reannotate_genes(ref_genome_id, chromosomes=None, workers=1, restart=False):
+    """Re-assign the genes of the variants of a reference genome, one chromosome per worker thread.
+
+    Returns the number of variants whose gene changed by chromosome.
+    """
+    chromosomes = chromosomes or [code for code, _ in CHROMOSOMES]
+
+    def run(chromosome):
+        try:
+            return reannotate_chromosome(ref_genome_id, chromosome, restart)
+        finally:
+            # Each worker thread has its own database connections
+            connections.close_all()
+
+    if workers <= 1:
+        return {chromosome: reannotate_chromosome(ref_genome_id, chromosome, restart) for chromosome in chromosomes}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(chromosomes, executor.map(run, chromosomes)))
@@ -0,0 +1,88 @@
+"""Time the in-memory part of the annotation ingest (dedupe, hot fields, packing) on synthetic VEP/SnpEff-like records.
+
+No database is used: the variants are not saved and the annotation name ids are made up. The number of annotations per
+record doubles at each run: the time per annotation should stay roughly constant with the set dedupe, and grow linearly
+with the list scan it replaced, timed alongside.
+"""
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from genomic.models import Annotation, Variant, pack_annotations
+from genomic.vcf_utils import AnnotationCollector, get_annotations_from_value, get_packed_annotations, \
+    project_hot_fields
+
+EFFECTS = ['missense_variant', 'synonymous_variant', 'stop_gained', 'frameshift_variant', 'intron_variant',
+           'splice_region_variant', '5_prime_UTR_variant', '3_prime_UTR_variant']
+IMPACTS = ['HIGH', 'MODERATE', 'LOW', 'MODIFIER']
+GENES = ['BRCA1', 'BRCA2', 'TP53', 'EGFR', 'KRAS', 'PIK3CA', 'PTEN', 'ATM', 'CHEK2', 'PALB2']
+FREQUENCY_FIELDS = ['gnomAD_AF', 'gnomAD_NFE_AF', 'ExAC_AF', '1000G_AF']
+
+
+def make_info(rng, transcripts):
+    """INFO of a record with an ANN entry per transcript, as written by SnpEff, and VEP-like frequency fields."""
+    gene = rng.choice(GENES)
+    ann = []
+    for i in range(transcripts):
+        effect = rng.choice(EFFECTS)
+        ann.append('|'.join([
+            'T', effect, rng.choice(IMPACTS), gene, gene, 'transcript', 'NM_{:06d}.{}'.format(rng.randint(0, 999), i % 3),
+            'protein_coding', '{}/20'.format(rng.randint(1, 20)),
+            'c.{}A>T'.format(rng.randint(1, 5000)), 'p.Lys{}Ter'.format(rng.randint(1, 1500)), '', '', '', '', ''
+        ]))
+    info = {'ANN': ann, 'GENE': [gene] * transcripts}
+    for field in FREQUENCY_FIELDS:
+        info[field] = [round(rng.random() / 100, 5)]
+    return info
+
+
+def list_scan_dedupe(annotations, transcript, name, value):
+    """Dedupe of the annotations of a variant as it was before AnnotationCollector, scanning the list."""
+    value = str(value)
+    if not any(annotation.name == name and annotation.value == value for annotation in annotations):
+        annotations.append(Annotation(transcript, name, value))
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the dedupe, interning and packing of the annotations at increasing numbers of annotations per '
+            'record, against the list scan dedupe.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=2000, help='Number of records of each run.')
+        parser.add_argument('--transcripts', type=int, default=10, help='ANN entries per record in the first run.')
+        parser.add_argument('--runs', type=int, default=5, help='Number of runs, each with twice the ANN entries.')
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        name_ids = {name: i for i, name in enumerate(['ANN', 'GENE'] + FREQUENCY_FIELDS, 1)}
+        transcripts = options['transcripts']
+        for _ in range(options['runs']):
+            infos = [make_info(rng, transcripts) for _ in range(options['records'])]
+
+            start = time.time()
+            strings = {}
+            count = 0
+            for info in infos:
+                variant = Variant(chromosome='01', position=1, ref='A', alt='T')
+                annotations = AnnotationCollector(strings)
+                for name, values in info.items():
+                    for value in values:
+                        get_annotations_from_value(variant, 0, name, value, annotations)
+                project_hot_fields(variant, annotations)
+                pack_annotations(get_packed_annotations(annotations, name_ids))
+                count += len(annotations)
+            elapsed = time.time() - start
+
+            start = time.time()
+            for info in infos:
+                annotations = []
+                for name, values in info.items():
+                    for value in values:
+                        list_scan_dedupe(annotations, 0, name, value)
+            list_elapsed = time.time() - start
+
+            self.stdout.write('{} ANN entries per record, {} annotations: set {:.2f}us, list scan {:.2f}us per annotation'
+                              .format(transcripts, count, elapsed / max(count, 1) * 1e6,
+                                      list_elapsed / max(count, 1) * 1e6))
+            transcripts *= 2
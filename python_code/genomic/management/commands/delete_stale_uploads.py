@@ -0,0 +1,17 @@
+"""Delete the chunked uploads abandoned before being ingested, see genomic.chunked_upload."""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from genomic.chunked_upload import delete_stale_uploads
+
+
+class Command(BaseCommand):
+    help = 'Delete the chunked uploads not ingested and not written to for some days, with their partial files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7)
+
+    def handle(self, *args, **options):
+        count = delete_stale_uploads(timedelta(days=options['days']))
+        self.stdout.write('{} uploads deleted'.format(count))
@@ -0,0 +1,14 @@
+"""Fill Variant.case for the variants ingested before it existed."""
+from django.core.management.base import BaseCommand
+
+from genomic.models import File, Variant
+
+
+class Command(BaseCommand):
+    help = 'Copy the case of the files to their variants which do not have it yet.'
+
+    def handle(self, *args, **options):
+        count = 0
+        for file_id, case_id in File.objects.values_list('id', 'case_id').iterator():
+            count += Variant.objects.filter(file_id=file_id, case__isnull=True).update(case_id=case_id)
+        self.stdout.write('{} variants updated'.format(count))
@@ -0,0 +1,23 @@
+"""Compute the content hash of the VCF files uploaded before it was stored, see genomic.vcf_utils.ingest_file."""
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from genomic.models import File
+from genomic.vcf_utils import file_sha256
+
+
+class Command(BaseCommand):
+    help = 'Store the SHA-256 of the VCF files which do not have one yet.'
+
+    def handle(self, *args, **options):
+        count = 0
+        for vcf_file in File.objects.filter(sha256__isnull=True).iterator():
+            path = os.path.join(settings.MEDIA_ROOT, str(vcf_file.file))
+            if not os.path.isfile(path):
+                self.stderr.write('Missing file {} for the File {}'.format(path, vcf_file.pk))
+                continue
+            File.objects.filter(pk=vcf_file.pk).update(sha256=file_sha256(path))
+            count += 1
+        self.stdout.write('{} files hashed'.format(count))
@@ -0,0 +1,32 @@
+"""Import the genes and transcripts of a reference genome, see genomic.gene_import."""
+from django.core.management.base import BaseCommand, CommandError
+
+from genomic.gene_import import FORMATS, GeneImportError, import_gene_models
+from genomic.models import File, RefGenome
+from genomic.vcf_utils import link_variant_influences
+
+
+class Command(BaseCommand):
+    help = 'Import the genes and transcripts of a GTF, GFF3 or BED file (optionally gzipped) for a reference genome.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Gene model file.')
+        parser.add_argument('--ref-genome', required=True, help='Name of the reference genome.')
+        parser.add_argument('--format', choices=FORMATS, help='Format of the file, guessed from its extension if omitted.')
+        parser.add_argument('--link-variants', action='store_true',
+                            help='Link the variants already ingested for this reference genome to their transcripts.')
+
+    def handle(self, *args, **options):
+        ref_genome = RefGenome.objects.filter(name=options['ref_genome']).first()
+        if ref_genome is None:
+            raise CommandError('Unknown reference genome {}'.format(options['ref_genome']))
+        try:
+            genes, transcripts = import_gene_models(options['path'], ref_genome, options['format'])
+        except (GeneImportError, OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write('{} new genes and {} new transcripts'.format(genes, transcripts))
+
+        if options['link_variants']:
+            file_ids = File.objects.filter(lab_info__pipeline__ref_genome=ref_genome).values_list('id', flat=True)
+            count = link_variant_influences(file_ids)
+            self.stdout.write('{} links of variants to transcripts created'.format(count))
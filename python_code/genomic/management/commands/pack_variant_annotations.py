@@ -0,0 +1,44 @@
+"""Pack the annotations of the variants ingested before Variant.annotations, see genomic.models.AnnotationName."""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from genomic.models import Variant, VariantAnnotation, pack_annotations
+from genomic.vcf_utils import (AnnotationCollector, get_annotation_index_keys, get_packed_annotations,
+                               project_hot_fields, save_annotation_index)
+
+
+class Command(BaseCommand):
+    help = ('Move the VariantAnnotation rows to the packed annotations of their variants, and fill the hot fields and '
+            'the annotation index.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        variant_ids = list(VariantAnnotation.objects.filter(variant__annotations=None)
+                           .values_list('variant_id', flat=True).distinct())
+        name_ids = {}
+        for start in range(0, len(variant_ids), batch_size):
+            ids = variant_ids[start:start + batch_size]
+            strings = {}
+            annotations = {variant_id: AnnotationCollector(strings) for variant_id in ids}
+            rows = VariantAnnotation.objects.filter(variant_id__in=ids).order_by('id')
+            for variant_id, transcript, name, value in rows.values_list('variant_id', 'transcript', 'name', 'value'):
+                annotations[variant_id].add(transcript, name, value)
+
+            with transaction.atomic():
+                index_keys = []
+                for variant in Variant.objects.filter(id__in=ids):
+                    project_hot_fields(variant, annotations[variant.id])
+                    variant.annotations = pack_annotations(get_packed_annotations(annotations[variant.id], name_ids))
+                    variant.save(update_fields=['annotations', 'effect', 'impact', 'hgvs_c', 'hgvs_p'])
+                    index_keys.extend(get_annotation_index_keys(variant, annotations[variant.id], name_ids))
+                save_annotation_index(index_keys, batch_size)
+                VariantAnnotation.objects.filter(variant_id__in=ids).delete()
+            self.stdout.write('{} of {} variants packed'.format(min(start + batch_size, len(variant_ids)),
+                                                                len(variant_ids)))
+
+        # The variants without any annotation do not need to look for VariantAnnotation rows anymore
+        count = Variant.objects.filter(annotations=None).update(annotations=pack_annotations({}))
+        self.stdout.write('{} variants without annotations'.format(count))
@@ -0,0 +1,27 @@
+"""Re-assign the genes of the variants of a reference genome, see genomic.gene_reannotation."""
+from django.core.management.base import BaseCommand, CommandError
+
+from genomic.gene_reannotation import reannotate_genes
+from genomic.models import CHROMOSOMES, RefGenome
+
+CHROMOSOME_CODES = {name: code for code, name in CHROMOSOMES}
+
+
+class Command(BaseCommand):
+    help = ('Re-assign the genes of the variants of a reference genome after new gene models were imported, resuming '
+            'the interrupted sweeps.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ref-genome', required=True, help='Name of the reference genome.')
+        parser.add_argument('--chromosome', action='append', choices=sorted(CHROMOSOME_CODES),
+                            help='Chromosome to sweep (01-22, X, Y, M), all of them if omitted. Can be repeated.')
+        parser.add_argument('--workers', type=int, default=1, help='Number of chromosomes swept in parallel.')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoints of interrupted sweeps.')
+
+    def handle(self, *args, **options):
+        ref_genome = RefGenome.objects.filter(name=options['ref_genome']).first()
+        if ref_genome is None:
+            raise CommandError('Unknown reference genome {}'.format(options['ref_genome']))
+        chromosomes = [CHROMOSOME_CODES[name] for name in options['chromosome'] or []]
+        changed = reannotate_genes(ref_genome.pk, chromosomes, options['workers'], options['restart'])
+        self.stdout.write('{} variants changed gene'.format(sum(changed.values())))
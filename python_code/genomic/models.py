@@ -1,7 +1,9 @@
 """Models form the Genomic app."""
 from __future__ import unicode_literals
 
+import json
 import os
+from collections import namedtuple
 
 from clinical.models import Case, Topography
 
@@ -31,6 +33,8 @@ class File(models.Model):
     size = models.IntegerField()
     topography = models.ForeignKey(Topography, models.PROTECT, blank=True, null=True)
     name = models.CharField(max_length=45, blank=True, null=True)
+    # SHA-256 of the content, the variants of identical files are copied rather than parsed again (see ingest_file)
+    sha256 = models.CharField(max_length=64, blank=True, null=True, db_index=True)
 
     class Meta:
         """To define the name of the table."""
@@ -42,11 +46,16 @@ class File(models.Model):
         return str(self.file).replace('vcf_files/' + str(self.case.project.id) + '/', '')
 
     def can_be_accessed_by(self, user):
-        return self.uploader == user\
-               or (self.uploader.profile.centre == user.profile.centre
-                   and user.groups.filter(name='Centre Admins').exists()) \
-               or user.groups.filter(name='Researchers').exists() \
-               or user.groups.filter(name='Clinicians').exists()
+        """See genomic.access, use get_access(request).can_access_file to check several files."""
+        from .access import AccessResolver
+        return AccessResolver(user).can_access_file(self)
+
+@receiver(models.signals.post_save, sender=File)
+def update_variants_case(sender, instance, created, **kwargs):
+    """Keep Variant.case in line with the case of the file."""
+    if not created:
+        Variant.objects.filter(file=instance).exclude(case_id=instance.case_id).update(case_id=instance.case_id)
+
 
 @receiver(models.signals.post_delete, sender=File)
 def auto_delete_file_on_delete(sender, instance, **kwargs):
@@ -58,6 +67,38 @@ def auto_delete_file_on_delete(sender, instance, **kwargs):
         if os.path.isfile(instance.file.path):
             os.remove(instance.file.path)
 
+
+class ChunkedUpload(models.Model):
+    """VCF file being uploaded in chunks, see chunked_upload."""
+
+    STATUSES = (('uploading', 'Uploading'), ('complete', 'Complete'), ('ingested', 'Ingested'))
+
+    token = models.CharField(unique=True, max_length=32)
+    uploader = models.ForeignKey(User, models.CASCADE)
+    name = models.CharField(max_length=45)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    offset = models.BigIntegerField(default=0)
+    status = models.CharField(max_length=17, choices=STATUSES, default='uploading')
+    # Set when the upload is started for a known case, the file is then ingested as soon as it is complete
+    case = models.ForeignKey(Case, models.CASCADE, blank=True, null=True)
+    lab_info = models.ForeignKey('LabInfo', models.PROTECT, blank=True, null=True)
+    format = models.CharField(max_length=17, default='vcf')
+    type = models.CharField(max_length=17, default='Somatic variants')
+    file = models.ForeignKey('File', models.SET_NULL, blank=True, null=True)
+    created_dt = models.DateTimeField(auto_now_add=True)
+    updated_dt = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        """To define the name of the table."""
+
+        db_table = 'chunked_upload'
+
+    def __str__(self):
+        """Str function."""
+        return '{} ({}/{} bytes)'.format(self.name, self.offset, self.size)
+
+
 class LabInfo(models.Model):
     """Object to keep track of what kind of processing, dry and wet, has been applied to the sample to produce the VCF files."""
 
@@ -155,6 +196,8 @@ def known_chromosome(chromosome):
 class Gene(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=45, unique=False)
+    # Id of the gene in its gene model (Ensembl/GENCODE gene_id, GFF3 ID), names being reused by distinct loci
+    accession = models.CharField(max_length=100, blank=True, null=True)
     ref_genome = models.ForeignKey('RefGenome', models.CASCADE, null=False)
     chromosome = models.IntegerField(choices=CHROMOSOMES)
     start_position = models.IntegerField()
@@ -162,6 +205,7 @@ class Gene(models.Model):
 
     class Meta:
         db_table = 'gene'
+        index_together = ('ref_genome', 'chromosome', 'start_position')
 
     def __str__(self):
         return self.name+' ('+self.ref_genome.name+')'
@@ -173,17 +217,40 @@ class Gene(models.Model):
         super(Gene, self).save(*args, **kwargs)
 
 
+class GeneAssignmentCheckpoint(models.Model):
+    """Progress of the re-assignment of the genes of the variants of a chromosome, see gene_reannotation."""
+
+    ref_genome = models.ForeignKey('RefGenome', models.CASCADE)
+    chromosome = models.IntegerField(choices=CHROMOSOMES)
+    # Last variant swept, in (position, id) order
+    last_position = models.IntegerField(null=True)
+    last_variant_id = models.IntegerField(null=True)
+    started_dt = models.DateTimeField(auto_now_add=True)
+    updated_dt = models.DateTimeField(auto_now=True)
+    finished_dt = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'gene_assignment_checkpoint'
+        unique_together = ('ref_genome', 'chromosome')
+
+
 SIGNIFICANCES = ((0, 'Benign'), (1, 'Likely benign'), (2, 'Uncertain significance'), (3, 'Likely pathogenic'), (4, 'Pathogenic'))
 
 
 class Variant(models.Model):
     file = models.ForeignKey('File', models.CASCADE)
+    # Copy of file.case, to find the variants of cases without joining vcf_file
+    case = models.ForeignKey(Case, models.CASCADE, null=True)
     chromosome = models.IntegerField(choices=CHROMOSOMES)
     position = models.IntegerField()
     ref = models.CharField(max_length=200)
     alt = models.CharField(max_length=200)
     description = models.CharField(max_length=200, null=True)
-    effect = models.CharField(max_length=200, null=True)
+    # Hot annotations projected from the INFO fields, see vcf_utils.HOT_FIELDS
+    effect = models.CharField(max_length=200, null=True, db_index=True)
+    impact = models.CharField(max_length=20, blank=True, null=True, db_index=True)
+    hgvs_c = models.CharField(max_length=200, blank=True, null=True, db_index=True)
+    hgvs_p = models.CharField(max_length=200, blank=True, null=True, db_index=True)
     genotype = models.CharField(max_length=10)
     depth_ref = models.IntegerField()
     depth_alt = models.IntegerField()
@@ -193,12 +260,15 @@ class Variant(models.Model):
     gene = models.ForeignKey('Gene', models.SET_NULL, null=True)
     checked = models.IntegerField(blank=True, null=True)
     significance = models.IntegerField(choices=SIGNIFICANCES, null=True)
+    # All the INFO annotations packed as JSON {annotation name id: [[transcript, value], ...]}, see AnnotationName
+    annotations = models.TextField(blank=True, null=True)
 
     variant_influences = models.ManyToManyField('Transcript')
 
     class Meta:
         db_table = 'variant'
         unique_together = ('file', 'position', 'ref', 'alt')
+        index_together = (('case', 'significance'), ('chromosome', 'position'))
 
     def __str__(self):
         # chromosome_name = 'chr' + self.get_chromosome_display()
@@ -214,11 +284,32 @@ class Variant(models.Model):
 
     @staticmethod
     def searchVariantsByPosition(ref_genome, chromosome, start_position, end_position):
-        return Variant.objects.filter(file__lab_info__pipeline__ref_genome=ref_genome).filter(chromosome=chromosome).filter(position__gte=start_position).filter(position__lte=end_position).order_by('file')
+        return Variant.objects.filter(file__lab_info__pipeline__ref_genome=ref_genome).filter(chromosome=chromosome).filter(position__gte=start_position).filter(position__lte=end_position).defer('annotations').order_by('file')
 
     @staticmethod
     def searchVariantsByGene(gene):
-        return Variant.objects.filter(gene=gene).order_by('file')
+        return Variant.objects.filter(gene=gene).defer('annotations').order_by('file')
+
+    @staticmethod
+    def searchVariantsByDiagnosis(diagnosis):
+        """Variants of the cases diagnosed with this diagnosis or one of its descendants (see DiagnosisAncestor)."""
+        return Variant.objects.filter(file__case__diagnosis__ancestor_links__ancestor=diagnosis).defer('annotations').order_by('file')
+
+    @staticmethod
+    def searchSignificantVariantsByCases(cases, min_significance=3):
+        """Variants of the cases with at least this significance (3 is likely pathogenic), on the (case, significance) index."""
+        return Variant.objects.filter(case__in=cases, significance__gte=min_significance).defer('annotations')
+
+    @staticmethod
+    def searchVariantsByAnnotations(annotations, variants=None):
+        """Variants (among variants if given, e.g. the results of another search) having all the (name, value)
+        annotations, each one looked up on the (name, value, variant) index of AnnotationIndex."""
+        if variants is None:
+            variants = Variant.objects.defer('annotations').order_by('file')
+        for name, value in annotations:
+            variants = variants.filter(id__in=AnnotationIndex.objects.filter(name__name=name, value__value=value)
+                                       .values('variant_id'))
+        return variants
 
     @staticmethod
     def getSignificanceKey(significance):
@@ -226,9 +317,105 @@ class Variant(models.Model):
         return next(iter([x[0] for x in SIGNIFICANCES if formatted_significance == x[1].lower()]), None)
 
     def get_annotations(self):
-        return list(VariantAnnotation.objects.filter(variant=self))
+        """Return the annotations of the variant (with transcript, name and value attributes)."""
+        if self.annotations is None:
+            # Ingested before the annotations were packed, see the pack_variant_annotations command
+            return list(VariantAnnotation.objects.filter(variant=self))
+        return unpack_annotations(self.annotations)
+
+
+class ClassificationBatch(models.Model):
+    """Classification of variants by a curator, see genomic.classification."""
+
+    user = models.ForeignKey(User, models.PROTECT)
+    classified_dt = models.DateTimeField(auto_now_add=True)
+    rule = models.TextField()  # JSON of the rule selecting the variants
+    significance = models.IntegerField(choices=SIGNIFICANCES, null=True)
+    checked = models.IntegerField(blank=True, null=True)
+    comment = models.TextField(blank=True)
+
+    class Meta:
+        db_table = 'classification_batch'
+
+
+class VariantClassification(models.Model):
+    """Previous classification of a variant changed by a batch, the audit trail of the classifications."""
+
+    batch = models.ForeignKey('ClassificationBatch', models.CASCADE)
+    variant = models.ForeignKey('Variant', models.CASCADE)
+    previous_significance = models.IntegerField(choices=SIGNIFICANCES, null=True)
+    previous_checked = models.IntegerField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'variant_classification'
+
+
+class AnnotationName(models.Model):
+    """Names of the INFO annotations, referred to by id in Variant.annotations."""
+
+    name = models.CharField(unique=True, max_length=50)
+
+    class Meta:
+        db_table = 'annotation_name'
+
+    def __str__(self):
+        return self.name
+
+
+class AnnotationValue(models.Model):
+    """Values of the annotations, interned for the AnnotationIndex."""
+
+    value = models.CharField(unique=True, max_length=200)
+
+    class Meta:
+        db_table = 'annotation_value'
+
+    def __str__(self):
+        return self.value
+
+
+class AnnotationIndex(models.Model):
+    """Inverted index of the annotations, one row per distinct (name, value) of a variant, see vcf_utils."""
+
+    name = models.ForeignKey('AnnotationName', models.CASCADE)
+    value = models.ForeignKey('AnnotationValue', models.CASCADE)
+    variant = models.ForeignKey('Variant', models.CASCADE, related_name='annotation_index')
+
+    class Meta:
+        db_table = 'annotation_index'
+        index_together = ('name', 'value', 'variant')
+
+
+Annotation = namedtuple('Annotation', ['transcript', 'name', 'value'])
+
+# Annotation name id -> name, only grows as names are never deleted
+_annotation_names = {}
+
+
+def get_annotation_names(name_ids):
+    """Return the names of the annotation name ids, loading the unknown ones."""
+    missing = [name_id for name_id in name_ids if name_id not in _annotation_names]
+    if missing:
+        _annotation_names.update(AnnotationName.objects.values_list('id', 'name'))
+    return {name_id: _annotation_names.get(name_id) for name_id in name_ids}
+
+
+def pack_annotations(annotations):
+    """Pack {annotation name id: [[transcript, value], ...]} for Variant.annotations."""
+    return json.dumps({str(name_id): values for name_id, values in annotations.items()}, separators=(',', ':'))
+
+
+def unpack_annotations(packed):
+    """Return the list of Annotation of Variant.annotations."""
+    annotations = json.loads(packed)
+    names = get_annotation_names([int(name_id) for name_id in annotations])
+    return [Annotation(transcript, names[int(name_id)], value)
+            for name_id, values in annotations.items() for transcript, value in values]
+
 
 class VariantAnnotation(models.Model):
+    """Annotations of the variants ingested before Variant.annotations, converted by pack_variant_annotations."""
+
     variant = models.ForeignKey('Variant', on_delete=models.CASCADE)
     transcript = models.IntegerField()
     name = models.CharField(max_length=50)
@@ -245,4 +432,7 @@ class Transcript(models.Model):
     isoform = models.CharField(max_length = 200)
     reference_sequence = models.CharField(max_length = 200)
     producing_gene = models.ForeignKey('Gene', models.CASCADE)
+    # Same coordinates as the variant positions, null for the transcripts created before the gene model imports
+    start_position = models.IntegerField(null=True)
+    end_position = models.IntegerField(null=True)
 
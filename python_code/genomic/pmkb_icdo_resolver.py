@@ -0,0 +1,81 @@
+"""Resolve the PMKB tumor and tissue type names to Morphology and Topography ids, see pmkb_icdo_mapping.
+
+The static mappings are compiled into hashed indexes on the exact, normalized and fuzzy (token sorted, singularized)
+forms of the names, joined to the ids of the ICD-O-3 codes. Names matching none of them are compared to the known
+names with difflib once, the result being memoized until the index is rebuilt.
+"""
+import difflib
+import logging
+import re
+
+from clinical.models import Morphology, Topography
+from clinical.ontology_utils import OntologyCache, morphology_codes, topography_codes
+
+from .pmkb_icdo_mapping import morphology_mapping, topography_mapping
+
+logger = logging.getLogger('django')
+
+# Minimum similarity for a name to be resolved by difflib
+FUZZY_CUTOFF = 0.85
+
+
+def _normalize(name):
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', name.casefold()).split())
+
+
+def _fuzzy(name):
+    tokens = [token[:-1] if len(token) > 3 and token.endswith('s') else token for token in _normalize(name).split()]
+    return ' '.join(sorted(tokens))
+
+
+def name_keys(name):
+    """Keys of a name in the indexes, from the most to the least strict."""
+    return name.strip().casefold(), _normalize(name), _fuzzy(name)
+
+
+class PmkbMappingIndex(OntologyCache):
+    """Hashed indexes of one PMKB mapping, rebuilt when the codes of the ontology model change."""
+
+    def __init__(self, model, mapping, code_resolver):
+        super(PmkbMappingIndex, self).__init__(model)
+        self.mapping = mapping
+        self.code_resolver = code_resolver
+
+    def build(self):
+        ids = self.code_resolver.resolve_many(code for _, code in self.mapping)
+        index = {}
+        names = {}
+        for name, code in self.mapping:
+            row_id = ids[code]
+            if row_id is None:
+                logger.warning('PMKB {} name {} is mapped to the unknown code {}'.format(self.model.__name__, name, code))
+                continue
+            for key in name_keys(name):
+                index.setdefault(key, row_id)
+            names.setdefault(row_id, []).append(name)
+        return {'index': index, 'names': names, 'fuzzy_matches': {}}
+
+    def resolve(self, name):
+        """Return the id of the ontology row for a PMKB name, or None."""
+        data = self.get()
+        keys = name_keys(name)
+        for key in keys:
+            if key in data['index']:
+                return data['index'][key]
+
+        fuzzy_matches = data['fuzzy_matches']
+        if keys[-1] not in fuzzy_matches:
+            close = difflib.get_close_matches(keys[-1], list(data['index']), n=1, cutoff=FUZZY_CUTOFF)
+            fuzzy_matches[keys[-1]] = data['index'][close[0]] if close else None
+        return fuzzy_matches[keys[-1]]
+
+    def resolve_many(self, names):
+        return {name: self.resolve(name) for name in names}
+
+    def names_for(self, row_id):
+        """Return the PMKB names mapped to an ontology row."""
+        return self.get()['names'].get(row_id, [])
+
+
+pmkb_tumor_types = PmkbMappingIndex(Morphology, morphology_mapping, morphology_codes)
+pmkb_tissue_types = PmkbMappingIndex(Topography, topography_mapping, topography_codes)
@@ -1,9 +1,13 @@
+import logging
 import re
 
 import xlrd
 from django.db import transaction
 
 from .models import *
+from .pmkb_icdo_resolver import pmkb_tissue_types, pmkb_tumor_types
+
+logger = logging.getLogger('django')
 
 
 def __read_row(sheet, row):
@@ -27,6 +31,13 @@ def __read_row(sheet, row):
     if len (tissue_types_raw) > 10:
         tissue_types_raw = []
 
+    for name, morphology_id in pmkb_tumor_types.resolve_many(tumor_types_raw).items():
+        if morphology_id is None:
+            logger.warning('PMKB tumor type {} is not mapped to a morphology'.format(name))
+    for name, topography_id in pmkb_tissue_types.resolve_many(tissue_types_raw).items():
+        if topography_id is None:
+            logger.warning('PMKB tissue type {} is not mapped to a topography'.format(name))
+
     tumor_types = map(lambda raw: PMKBTumorType.objects.get_or_create(tumor_name=raw), tumor_types_raw)
     tissue_types = map(lambda raw: PMKBTissueType.objects.get_or_create(tissue_name=raw), tissue_types_raw)
     variants = map(lambda raw: PMKBVariant.objects.get_or_create(variant_name=raw), variants_raw)
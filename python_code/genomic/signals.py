@@ -0,0 +1,6 @@
+"""Signals of the genomic app."""
+from django.dispatch import Signal
+
+# Sent with a ClassificationBatch (batch) once the significance or checked state of its variants was changed, and
+# the ids of the cases of these variants.
+variants_classified = Signal(providing_args=['batch', 'case_ids'])
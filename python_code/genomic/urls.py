@@ -12,4 +12,12 @@ urlpatterns = [
     url(r'^extra-info/(?P<gene_name>[A-Z0-9]+)$', views.ExtraInfoEndpoint.as_view(), name='extra_info_endpoint'),
     url(r'^batch-upload/$', views.BatchUploadView.as_view(), name='batch_upload'),
     url(r'^api/batch_upload/$', views.BatchUploadApiEndpoint.as_view(), name='batch_upload_endpoint'),
+    url(r'^api/variants/$', views.VariantSearchEndpoint.as_view(), name='variant_search_endpoint'),
+    url(r'^api/variants/classify/$', views.VariantClassificationEndpoint.as_view(),
+        name='variant_classification_endpoint'),
+    url(r'^api/uploads/$', views.ChunkedUploadEndpoint.as_view(), name='chunked_upload_endpoint'),
+    url(r'^api/uploads/(?P<upload_id>[0-9a-f]{32})/$', views.ChunkedUploadChunkEndpoint.as_view(),
+        name='chunked_upload_chunk_endpoint'),
+    url(r'^api/uploads/(?P<upload_id>[0-9a-f]{32})/finalize/$', views.ChunkedUploadFinalizeEndpoint.as_view(),
+        name='chunked_upload_finalize_endpoint'),
 ]
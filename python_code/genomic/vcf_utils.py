@@ -1,11 +1,18 @@
+import bisect
+import hashlib
 import logging
+import operator
 import os
 import re
+from functools import reduce
 
 import vcf
 from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
 
-from .models import Variant, Gene, VariantAnnotation
+from .models import Annotation, AnnotationIndex, AnnotationName, AnnotationValue, File, Variant, Gene, LabInfo, Pipeline, \
+    Transcript, VariantAnnotation, pack_annotations
 
 
 class ChromosomeFormat:
@@ -53,10 +60,9 @@ def save_variants(vcf_file):
         else:
             raise ValueError('Unknown chromosome format: {}'.format(chromosome))
 
-        gene = Gene.objects.filter(chromosome=chromosome).filter(start_position__lte=record.POS).filter(end_position__gte=record.POS).first()
         variant = Variant(
             file=vcf_file,
-            gene=gene,
+            case_id=vcf_file.case_id,
             chromosome=chromosome,
             position=record.POS,
             # dbsnp_id=record.ID,
@@ -76,11 +82,15 @@ def save_variants(vcf_file):
 
         variants[(chromosome, record.POS)].append((variant, record.INFO))
 
-    annotations = []
+    genes = GeneIntervals(vcf_file.lab_info.pipeline.ref_genome_id, get_position_ranges(variants))
+    name_ids = {}  # annotation name -> AnnotationName id
+    strings = {}  # annotation names and values of the file, interned
+    index_keys = []
 
     for key, vars in variants.items():
         variant = vars[0][0]
-        variant.save()
+        variant.gene_id = genes.find(*key)
+        annotations = AnnotationCollector(strings)
         transcript = 0
         for _, info in vars:
             for name, values in info.items():
@@ -92,24 +102,283 @@ def save_variants(vcf_file):
 
             transcript += 1
 
+        project_hot_fields(variant, annotations)
+        variant.annotations = pack_annotations(get_packed_annotations(annotations, name_ids))
+        variant.save()
+        index_keys.extend(get_annotation_index_keys(variant, annotations, name_ids))
+
+    save_annotation_index(index_keys)
+    link_variant_influences([vcf_file.pk])
     return count
 
 
+def get_position_ranges(positions):
+    """(lowest, highest) position by chromosome of (chromosome, position) pairs."""
+    ranges = {}
+    for chromosome, position in positions:
+        low, high = ranges.get(chromosome, (position, position))
+        ranges[chromosome] = (min(low, position), max(high, position))
+    return ranges
+
+
+class GeneIntervals:
+    """Genes of a reference genome sorted by start on each chromosome, to find the gene of many positions in memory.
+
+    Only the genes overlapping ranges ({chromosome: (lowest, highest) position}) are loaded when given.
+    """
+
+    def __init__(self, ref_genome_id, ranges=None):
+        genes = Gene.objects.filter(ref_genome_id=ref_genome_id)
+        if ranges is not None:
+            genes = genes.filter(reduce(operator.or_, [
+                Q(chromosome=chromosome, start_position__lte=high, end_position__gte=low)
+                for chromosome, (low, high) in ranges.items()
+            ], Q(pk__in=[])))
+        self.starts = {}  # chromosome -> sorted gene starts
+        self.genes = {}  # chromosome -> (end, id) of the genes in the same order
+        self.max_length = {}  # chromosome -> length of its longest gene
+        for gene_id, chromosome, start, end in genes.order_by('chromosome', 'start_position', 'id').values_list(
+                'id', 'chromosome', 'start_position', 'end_position'):
+            self.starts.setdefault(chromosome, []).append(start)
+            self.genes.setdefault(chromosome, []).append((end, gene_id))
+            self.max_length[chromosome] = max(self.max_length.get(chromosome, 0), end - start)
+
+    def find(self, chromosome, position):
+        """Id of the first gene (by start) containing the position, None if there is none."""
+        starts = self.starts.get(chromosome)
+        if not starts:
+            return None
+        # The genes starting before position - max_length cannot reach it
+        low = bisect.bisect_left(starts, position - self.max_length[chromosome])
+        high = bisect.bisect_right(starts, position)
+        for end, gene_id in self.genes[chromosome][low:high]:
+            if end >= position:
+                return gene_id
+        return None
+
+
+def link_variant_influences(file_ids, batch_size=500):
+    """Link the variants of the files to the transcripts they fall in, with one INSERT ... SELECT per batch of files.
+
+    The transcripts are found through the genes of the reference genome of each file, on the index of their starts:
+    only the genes starting less than the longest gene of the chromosome before a variant can contain it, which bounds
+    the range read on the index as in GeneIntervals.find.
+    """
+    quote = connection.ops.quote_name
+    file_ids = list(file_ids)
+    through = quote(Variant.variant_influences.through._meta.db_table)
+    count = 0
+    for start in range(0, len(file_ids), batch_size):
+        ids = file_ids[start:start + batch_size]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {through} (variant_id, transcript_id) SELECT v.id, t.id FROM {variant} v '
+                'JOIN {file} f ON f.id = v.file_id '
+                'JOIN {lab_info} l ON l.id = f.lab_info_id '
+                'JOIN {pipeline} p ON p.id = l.pipeline_id '
+                'JOIN (SELECT ref_genome_id, chromosome, MAX(end_position - start_position) AS max_length '
+                'FROM {gene} GROUP BY ref_genome_id, chromosome) m '
+                'ON m.ref_genome_id = p.ref_genome_id AND m.chromosome = v.chromosome '
+                'JOIN {gene} g ON g.ref_genome_id = p.ref_genome_id AND g.chromosome = v.chromosome '
+                'AND g.start_position >= v.position - m.max_length AND g.start_position <= v.position '
+                'AND g.end_position >= v.position '
+                'JOIN {transcript} t ON t.producing_gene_id = g.id '
+                'AND t.start_position <= v.position AND t.end_position >= v.position '
+                'WHERE v.file_id IN ({ids}) AND NOT EXISTS '
+                '(SELECT 1 FROM {through} e WHERE e.variant_id = v.id AND e.transcript_id = t.id)'.format(
+                    through=through, variant=quote(Variant._meta.db_table), file=quote(File._meta.db_table),
+                    lab_info=quote(LabInfo._meta.db_table), pipeline=quote(Pipeline._meta.db_table),
+                    gene=quote(Gene._meta.db_table), transcript=quote(Transcript._meta.db_table),
+                    ids=', '.join(['%s'] * len(ids))),
+                ids)
+            count += cursor.rowcount
+    return count
+
+
+class AnnotationCollector:
+    """Annotations of a variant, deduplicated on (name, value) with a set.
+
+    The names and values are interned in strings, shared by the variants of a file, so that the same string read again
+    for each record is only kept once.
+    """
+
+    def __init__(self, strings=None):
+        self.annotations = []
+        self.seen = set()
+        self.strings = {} if strings is None else strings
+
+    def add(self, transcript, name, value):
+        """Add an annotation, returns False if it was already there."""
+        key = (name, value)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        self.annotations.append(Annotation(transcript, self.strings.setdefault(name, name),
+                                           self.strings.setdefault(value, value)))
+        return True
+
+    def __iter__(self):
+        return iter(self.annotations)
+
+    def __len__(self):
+        return len(self.annotations)
+
+
 def get_annotations_from_value(variant, transcript, name, value, annotations):
-    if (variant.id, name, value) not in annotations:
-        if name in ('DBSNP') and not variant.dbsnp_id:
-            variant.dbsnp_id = 'rs' + str(value)
-            variant.save()
-        elif name in ('CLI_ASSESSMENT') and not variant.checked:
+    """Add an annotation of the variant to annotations (its AnnotationCollector), unless it is already there.
+
+    Some annotations set fields of the variant, which is saved by the caller.
+    """
+    value = str(value)
+    if annotations.add(transcript, name, value):
+        if name == 'DBSNP' and not variant.dbsnp_id:
+            variant.dbsnp_id = 'rs' + value
+        elif name == 'CLI_ASSESSMENT' and not variant.checked:
             variant.significance = Variant.getSignificanceKey(value)
             variant.checked = True
-            variant.save()
-        elif name in ('ING_CLASSIFICATION') and not variant.significance:
+        elif name == 'ING_CLASSIFICATION' and not variant.significance:
             variant.significance = Variant.getSignificanceKey(value)
-            variant.save()
-
-        annotation = VariantAnnotation(variant=variant, transcript=transcript, name=name, value=value)
-        annotation.save()
-        annotations.append((variant.id, name, value))
 
     return annotations
+
+
+def get_packed_annotations(annotations, name_ids):
+    """Group the annotations by name id, the ids of the new names are added to name_ids."""
+    packed = {}
+    for annotation in annotations:
+        if annotation.name not in name_ids:
+            name_ids[annotation.name] = AnnotationName.objects.get_or_create(name=annotation.name)[0].id
+        packed.setdefault(name_ids[annotation.name], []).append([annotation.transcript, annotation.value])
+    return packed
+
+
+def get_annotation_index_keys(variant, annotations, name_ids):
+    """(variant id, name id, value) of the distinct annotations of a saved variant, the too long values are left out."""
+    max_length = AnnotationValue._meta.get_field('value').max_length
+    keys = {(name_ids[annotation.name], annotation.value) for annotation in annotations
+            if len(annotation.value) <= max_length}
+    return [(variant.id, name_id, value) for name_id, value in keys]
+
+
+def get_annotation_value_ids(values, batch_size=500):
+    """Return the AnnotationValue ids of the values by value, creating the missing ones."""
+    values = sorted(set(values))
+    ids = {}
+    for start in range(0, len(values), batch_size):
+        ids.update(AnnotationValue.objects.filter(value__in=values[start:start + batch_size]).values_list('value', 'id'))
+
+    missing = [value for value in values if value not in ids]
+    try:
+        with transaction.atomic():
+            AnnotationValue.objects.bulk_create([AnnotationValue(value=value) for value in missing], batch_size=batch_size)
+    except IntegrityError:
+        # Created meanwhile by another ingest, or equal to an existing value for the collation of the database
+        pass
+    # bulk_create does not return the ids with this database backend
+    for start in range(0, len(missing), batch_size):
+        ids.update(AnnotationValue.objects.filter(value__in=missing[start:start + batch_size]).values_list('value', 'id'))
+    for value in missing:
+        if value not in ids:
+            ids[value] = AnnotationValue.objects.get_or_create(value=value)[0].id
+    return ids
+
+
+def save_annotation_index(keys, batch_size=500):
+    """Insert the AnnotationIndex rows of (variant id, name id, value) keys, the values being interned first."""
+    value_ids = get_annotation_value_ids(value for _, _, value in keys)
+    AnnotationIndex.objects.bulk_create(
+        [AnnotationIndex(variant_id=variant_id, name_id=name_id, value_id=value_ids[value])
+         for variant_id, name_id, value in keys],
+        batch_size=batch_size
+    )
+
+
+# INFO annotation name (upper case) -> Variant column it is copied to
+HOT_FIELDS = {
+    'EFFECT': 'effect',
+    'CONSEQUENCE': 'effect',
+    'IMPACT': 'impact',
+    'HGVS_C': 'hgvs_c',
+    'HGVSC': 'hgvs_c',
+    'HGVS_P': 'hgvs_p',
+    'HGVSP': 'hgvs_p',
+}
+
+# Position in the SnpEff ANN annotations (Allele | Annotation | Annotation_Impact | ... | HGVS.c | HGVS.p | ...)
+# -> Variant column it is copied to
+ANN_HOT_FIELDS = {1: 'effect', 2: 'impact', 9: 'hgvs_c', 10: 'hgvs_p'}
+
+
+def project_hot_fields(variant, annotations):
+    """Copy the first value of the hot annotations to their columns of the variant."""
+    def set_field(column, value):
+        if value and getattr(variant, column) is None:
+            setattr(variant, column, value[:Variant._meta.get_field(column).max_length])
+
+    for annotation in annotations:
+        name = annotation.name.upper()
+        if name in HOT_FIELDS:
+            set_field(HOT_FIELDS[name], annotation.value)
+        elif name == 'ANN':
+            parts = annotation.value.split('|')
+            for position, column in ANN_HOT_FIELDS.items():
+                if position < len(parts):
+                    set_field(column, parts[position])
+
+
+def file_sha256(path, buffer_size=1024 * 1024):
+    """SHA-256 hex digest of a file on disk, read by pieces."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as opened_file:
+        for data in iter(lambda: opened_file.read(buffer_size), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def uploaded_file_sha256(uploaded_file):
+    """SHA-256 hex digest of an uploaded file, read by chunks."""
+    digest = hashlib.sha256()
+    for data in uploaded_file.chunks():
+        digest.update(data)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+
+def ingest_file(vcf_file):
+    """Save the variants of a file, copied from an already ingested file with the same content if there is one."""
+    source = None
+    if vcf_file.sha256:
+        source = File.objects.filter(sha256=vcf_file.sha256).exclude(pk=vcf_file.pk).order_by('id').first()
+    if source is None:
+        return save_variants(vcf_file)
+    logger.info('{} has the same content as the file {}, copying its variants'.format(vcf_file.name, source.pk))
+    return copy_variants(source, vcf_file)
+
+
+def copy_variants(source_file, target_file):
+    """Copy the variants of a file, with their annotations and transcripts, to another one with set-based inserts."""
+    quote = connection.ops.quote_name
+    variant_table = quote(Variant._meta.db_table)
+    variant_columns = ', '.join(quote(field.column) for field in Variant._meta.concrete_fields
+                                if field.name not in ('id', 'file', 'case'))
+    # Variants are unique by (file, position, ref, alt), which matches the copies to their originals
+    copies = ('JOIN {variant} src ON link.variant_id = src.id '
+              'JOIN {variant} dst ON dst.file_id = %s AND dst.position = src.position '
+              'AND dst.ref = src.ref AND dst.alt = src.alt WHERE src.file_id = %s').format(variant=variant_table)
+    params = [target_file.pk, source_file.pk]
+
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO {variant} (file_id, case_id, {columns}) SELECT %s, %s, {columns} FROM {variant} '
+                       'WHERE file_id = %s'.format(variant=variant_table, columns=variant_columns),
+                       [target_file.pk, target_file.case_id, source_file.pk])
+        count = cursor.rowcount
+        for model in (VariantAnnotation, AnnotationIndex):
+            columns = [field.column for field in model._meta.concrete_fields if field.name not in ('id', 'variant')]
+            cursor.execute('INSERT INTO {table} (variant_id, {columns}) SELECT dst.id, {link_columns} FROM {table} link {copies}'
+                           .format(table=quote(model._meta.db_table),
+                                   columns=', '.join(quote(column) for column in columns),
+                                   link_columns=', '.join('link.' + quote(column) for column in columns),
+                                   copies=copies), params)
+        cursor.execute('INSERT INTO {table} (variant_id, transcript_id) SELECT dst.id, link.transcript_id FROM {table} link {copies}'
+                       .format(table=quote(Variant.variant_influences.through._meta.db_table), copies=copies), params)
+    return count
@@ -2,7 +2,6 @@ import csv
 import html
 import json
 import logging
-import os
 from datetime import datetime
 from io import StringIO
 
@@ -10,9 +9,10 @@ from io import StringIO
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied, ValidationError
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
 from django.db import IntegrityError, transaction
-from django.http import HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
+from django.http import Http404, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
 from django.urls import reverse
 from django.utils import timezone
@@ -21,16 +21,37 @@ from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
-from aauh.get_redcap_data import find_patient_ids_by_cpr, retrieve_redcap_data, retrieve_project
 from clinical.models import *
+from clinical.ontology_utils import diagnosis_codes, morphology_codes, topography_codes
+from clinical.redcap_mirror import get_cpr_to_patient_id_dict, sync_redcap_mirror
+from clinical.views import stream_list_response
 from profile.models import Centre
+from .access import get_access
+from .chunked_upload import (CHUNK_SIZE, ChunkedUploadError, OffsetMismatch, complete_upload, consume_duplicate_upload,
+                             create_file_from_upload, ingest_upload, start_upload, write_chunk)
+from .classification import classify_variants
+from .file_purge import purge_files
 from .forms import SearchByPositionForm, SearchByGeneForm, VcfForm
-from .models import File, Variant, RefGenome, Gene, LabInfo
-from .vcf_utils import save_variants
+from .models import CHROMOSOMES, ChunkedUpload, File, Variant, RefGenome, Gene, LabInfo
+from .vcf_utils import ingest_file, uploaded_file_sha256
 
 
 logger = logging.getLogger('django')
 
+# Number of keys per IN (...) query, SQL Server accepts at most 2100 parameters per query
+BATCH_QUERY_SIZE = 500
+
+# Chromosome code by name (01-22, X, Y, M)
+CHROMOSOME_CODES = {name: code for code, name in CHROMOSOMES}
+
+
+class TemporaryFileUploadMixin:
+    """Spool the uploaded files to disk whatever their size, instead of keeping the small ones in worker memory."""
+
+    def dispatch(self, request, *args, **kwargs):
+        request.upload_handlers = [TemporaryFileUploadHandler(request)]
+        return super(TemporaryFileUploadMixin, self).dispatch(request, *args, **kwargs)
+
 
 class FileUploadApiBase:
     def post(self, request):
@@ -58,7 +79,8 @@ class FileUploadApiBase:
 
                 res = File.objects.update_or_create(
                     file=file, case=case, uploader=uploader, lab_info=lab_info,
-                    format=format, type=type, uploaded_dt=uploaded_dt, size=size, name=name
+                    format=format, type=type, uploaded_dt=uploaded_dt, size=size, name=name,
+                    sha256=uploaded_file_sha256(file)
                 )
                 return HttpResponseRedirect(reverse('file', kwargs={'file_id': res[0].pk}))
             except MultiValueDictKeyError as e:
@@ -87,24 +109,24 @@ class FileUploadApiBase:
             project = Project.objects.get(pk=project_id)
             created_time = post['created_time']
             morphology_code = post['morphology_code']
-            morphology = Morphology.get_by_icdo3_code(morphology_code)
+            morphology_id = morphology_codes.resolve(morphology_code)
             topography_code = post['topography_code']
-            topography = Topography.get_by_icdo3_code(topography_code)
+            topography_id = topography_codes.resolve(topography_code)
             diagnosis_code = post['diagnosis_code']
-            diagnosis = Diagnosis.get_by_icd10_code(diagnosis_code)
+            diagnosis_id = diagnosis_codes.resolve(diagnosis_code)
             diagnosis_time = post['diagnosis_date']
             relapse = post['relapse']
 
-            if topography is None:
+            if topography_id is None:
                 return 'Unknown Topography'
-            if morphology is None:
+            if morphology_id is None:
                 return 'Unknown Morphology'
-            if diagnosis is None:
+            if diagnosis_id is None:
                 return 'Unknown Diagnosis'
 
             res = Case.objects.create(
                 project=project, created_dt=created_time,
-                patient=patient, morphology=morphology, topography=topography, diagnosis=diagnosis,
+                patient=patient, morphology_id=morphology_id, topography_id=topography_id, diagnosis_id=diagnosis_id,
                 diagnosis_date=diagnosis_time, relapse_number=relapse
             )
             return res
@@ -119,8 +141,9 @@ class FileUploadApiBase:
 class FileView(LoginRequiredMixin, View, FileUploadApiBase):
     def get(self, request, file_id):
         try:
-            file = File.objects.get(pk=file_id)
-            if not file.can_be_accessed_by(request.user) and settings.ENFORCE_FILE_ACCESS_RESTRICTIONS:
+            file = File.objects.select_related('uploader').get(pk=file_id)
+            download_access = get_access(request).can_access_file(file)
+            if not download_access and settings.ENFORCE_FILE_ACCESS_RESTRICTIONS:
                 return render(request, 'genomic/file_no_access.html', {'uploader': file.uploader})
         except KeyError:
             # typically there is no 'id' in the GET parameters
@@ -136,7 +159,6 @@ class FileView(LoginRequiredMixin, View, FileUploadApiBase):
         drugs = {var.gene: find_drugs_targeting_gene(var.gene.name) for var in variants if var.gene}
         pmkbs = {var.gene: list(PMKBGeneInfo.objects.filter(gene__iexact=var.gene.name).all()) for var in variants if var.gene}
         annotations = {(var.chromosome, var.position): [{ann.name: [ann.value, ann.transcript]} for ann in var.get_annotations()] for var in variants}
-        download_access = file.can_be_accessed_by(request.user)
         download_url = file.file.url
 
         return render(
@@ -148,7 +170,7 @@ class FileView(LoginRequiredMixin, View, FileUploadApiBase):
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class FileUploadEndpoint(View, FileUploadApiBase):
+class FileUploadEndpoint(TemporaryFileUploadMixin, View, FileUploadApiBase):
     pass  # Use inherited post, nothing else needed for now
 
 
@@ -159,9 +181,9 @@ class FilesListView(LoginRequiredMixin, View):
         if form.is_valid():
             vcf_file = form.save()
             try:
-                save_variants(vcf_file)
+                ingest_file(vcf_file)
             except Exception as e:
-                vcf_file.delete()
+                purge_files([vcf_file.pk])
                 # slug = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(12))
                 # print(slug)
                 # old_file_name = os.path.join(settings.MEDIA_ROOT, vcf_file.file.__str__())
@@ -231,12 +253,98 @@ class SearchVariantsView(LoginRequiredMixin, View):
                             ' for ref genome ' + ref_genome.name
                         )
 
+        annotations = parse_annotation_filters(request.GET.getlist('annotation'))
+        if annotations:
+            # Composed with the gene or position search, or across the whole cohort without them
+            variants = Variant.searchVariantsByAnnotations(
+                annotations, None if isinstance(variants, dict) else variants)
+
+        if settings.ENFORCE_FILE_ACCESS_RESTRICTIONS and not isinstance(variants, dict):
+            variants = variants.filter(get_access(request).files_filter('file__'))
+
+        if request.GET.get('diagnosis') and not isinstance(variants, dict):
+            # ICD-10 code, restricting the results to the cases diagnosed with it or any of its descendants
+            diagnosis_id = diagnosis_codes.resolve(request.GET['diagnosis'])
+            if diagnosis_id is None:
+                messages.info(request, 'Unknown diagnosis code ' + html.escape(request.GET['diagnosis']))
+                variants = variants.none()
+            else:
+                variants = variants.filter(file__case__diagnosis__ancestor_links__ancestor_id=diagnosis_id)
+
+        if annotations and not variants.exists():
+            messages.info(request, 'No case found with the annotations ' + html.escape(', '.join(
+                request.GET.getlist('annotation'))))
+
         return render(
             request, 'genomic/search.html',
             {'gene_form': gene_form, 'position_form': position_form, 'variants': variants, 'extra_info': extra_info, 'known_drugs': known_drugs}
         )
 
 
+def parse_annotation_filters(filters):
+    """Parse annotation filters of the form NAME=VALUE into (name, value) pairs, the malformed ones are ignored."""
+    return [tuple(annotation.split('=', 1)) for annotation in filters if '=' in annotation]
+
+
+class VariantSearchEndpoint(LoginRequiredMixin, View):
+    """Search the variants of the cohort, streamed as JSON (see stream_list_response for the after/limit pagination).
+
+    All the given criteria must match: gene (name), chromosome (01-22, X, Y or M) with start and end positions on the
+    ref_genome (name, required with the chromosome), annotation (NAME=VALUE,
+    repeatable, looked up on the annotation index), effect, impact, hgvs_c and hgvs_p (hot annotation columns), and
+    diagnosis (ICD-10 code, including its descendants).
+    """
+
+    def get(self, request):
+        variants = Variant.objects.defer('annotations').select_related('gene')
+        criteria = False
+        try:
+            if request.GET.get('gene'):
+                variants = variants.filter(gene__name=request.GET['gene'])
+                criteria = True
+            if request.GET.get('chromosome'):
+                name = request.GET['chromosome'].upper()
+                chromosome = CHROMOSOME_CODES.get(name.zfill(2) if name.isdigit() else name)
+                if chromosome is None:
+                    return HttpResponseBadRequest('Unknown chromosome ' + request.GET['chromosome'])
+                ref_genome = RefGenome.objects.filter(name=request.GET.get('ref_genome')).first()
+                if ref_genome is None:
+                    return HttpResponseBadRequest('A known ref_genome is needed to search by position')
+                variants = variants.filter(file__lab_info__pipeline__ref_genome=ref_genome, chromosome=chromosome,
+                                           position__gte=int(request.GET.get('start', 1)),
+                                           position__lte=int(request.GET.get('end', 1000000000)))
+                criteria = True
+        except ValueError:
+            return HttpResponseBadRequest('start and end must be integers')
+        for column in ('effect', 'impact', 'hgvs_c', 'hgvs_p'):
+            if request.GET.get(column):
+                variants = variants.filter(**{column: request.GET[column]})
+                criteria = True
+        annotations = parse_annotation_filters(request.GET.getlist('annotation'))
+        if annotations:
+            variants = Variant.searchVariantsByAnnotations(annotations, variants)
+            criteria = True
+        if request.GET.get('diagnosis'):
+            diagnosis_id = diagnosis_codes.resolve(request.GET['diagnosis'])
+            if diagnosis_id is None:
+                return HttpResponseBadRequest('Unknown diagnosis code ' + request.GET['diagnosis'])
+            variants = variants.filter(case__diagnosis__ancestor_links__ancestor_id=diagnosis_id)
+            criteria = True
+        if not criteria:
+            return HttpResponseBadRequest('At least one search criterion is needed')
+        if settings.ENFORCE_FILE_ACCESS_RESTRICTIONS:
+            variants = variants.filter(get_access(request).files_filter('file__'))
+        # Variants have no update date, updated_since is rejected
+        return stream_list_response(request, variants, self._serialize, updated_field=None)
+
+    @staticmethod
+    def _serialize(v):
+        return {'id': v.id, 'file': v.file_id, 'case': v.case_id, 'chromosome': v.get_chromosome_display(),
+                'position': v.position, 'ref': v.ref, 'alt': v.alt, 'gene': v.gene.name if v.gene else None,
+                'effect': v.effect, 'impact': v.impact, 'hgvs_c': v.hgvs_c, 'hgvs_p': v.hgvs_p,
+                'significance': v.significance}
+
+
 class DrugView(LoginRequiredMixin, View):
     def get(self, request, drug_id):
         drug = Drug.objects.get(pk=drug_id)
@@ -247,8 +355,8 @@ class DrugView(LoginRequiredMixin, View):
 
 #CV# same function in clinical/views.py, should be refactored
 def get_accessible_case(request, case_id):
-    case = Case.objects.get(pk=case_id)
-    if case.patient.centre.id != request.user.profile.centre.id:
+    case = Case.objects.select_related('patient').get(pk=case_id)
+    if not get_access(request).can_access_case(case):
         raise PermissionDenied('The user does not have access to this case')
     return case
 
@@ -306,14 +414,16 @@ class BatchUploadView(LoginRequiredMixin, View):
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class BatchUploadApiEndpoint(View):
+class BatchUploadApiEndpoint(TemporaryFileUploadMixin, View):
     def post(self, request):
-        import pandas
-
-        (clin_df, incl_df, lab_df) = retrieve_redcap_data(events_for_clin='case_arm_1, case_arm_2, case_arm_3')
-        error_records = pandas.DataFrame(columns=['text', 'severity', 'type', 'area'])
-        cpr_to_patient_id_dict = find_patient_ids_by_cpr(error_records, incl_df, clin_df)
-        valid_patient_ids = Patient.objects.values_list('id', flat=True)
+        # Only the REDCap records modified since the last upload are exported, the CPRs are looked up in the mirror
+        try:
+            sync_redcap_mirror()
+        except (OSError, ValueError) as e:
+            logger.warning('Could not synchronize the REDCap mirror, using the last snapshot: ' + str(e))
+        cpr_to_patient_id_dict = get_cpr_to_patient_id_dict()
+        # Evaluated once, not at every membership test
+        valid_patient_ids = set(Patient.objects.values_list('id', flat=True))
 
         with transaction.atomic():
             report = []
@@ -322,7 +432,10 @@ class BatchUploadApiEndpoint(View):
                 data_json = request.POST['data']
                 data_list = json.loads(data_json)
 
-                uploaded_file_names = [file.name for file in request.FILES.values()]
+                # Files sent beforehand with the chunked upload protocol, by name
+                uploads = BatchUploadApiEndpoint._get_complete_uploads(request)
+
+                uploaded_file_names = [file.name for file in request.FILES.values()] + list(uploads)
                 metadata_file_names = [data[2] for data in data_list]
                 files_to_indices = json.loads(request.POST['files-to-indices'])
 
@@ -344,6 +457,8 @@ class BatchUploadApiEndpoint(View):
                                            file.name)))
                         dirty_files.append(file.name)
 
+                # First pass: validate the rows and gather the (patient id, diagnosis date, file name) keys
+                rows = []
                 for file_data in data_list:
                     file_name = file_data[2].lstrip().rstrip()
                     cpr_or_id = file_data[0].lstrip().rstrip()
@@ -374,11 +489,49 @@ class BatchUploadApiEndpoint(View):
                                                                                      " Error msg: " + str(error)
                             ))
                         continue
-                    # INFO / WARNING : Hard coding the centre to 'AAUH'
-                    # TO-DO: Make a solution which does not crash if the centre name of Aaalborg is changed.
                     patient_id = cpr_to_patient_id_dict.get(cpr_or_id, cpr_or_id)  # If it isn't in the dict at this
                                                                                    # point, it must be a valjd patient id
-                    patients = Patient.objects.filter(centre_patient_id=patient_id, centre__name='AAUH')
+                    # Matched against the centre_patient_id strings, the CPR map can give numbers
+                    patient_id = str(patient_id)
+                    rows.append((file_name, cpr_or_id, date_str, diag_datetime_obj.date(), patient_id))
+
+                # Resolve all the keys with a few bulk queries
+                # INFO / WARNING : Hard coding the centre to 'AAUH' and the project to 'AAUH Project'
+                # TO-DO: Make a solution which does not crash if the centre name of Aaalborg or the project is changed.
+                patients_by_id = {}
+                patient_ids = sorted({row[4] for row in rows})
+                for start in range(0, len(patient_ids), BATCH_QUERY_SIZE):
+                    for patient in Patient.objects.filter(centre_patient_id__in=patient_ids[start:start + BATCH_QUERY_SIZE],
+                                                          centre__name='AAUH'):
+                        patients_by_id.setdefault(patient.centre_patient_id, []).append(patient)
+
+                cases_by_key = {}
+                found_patients = sorted(patients[0].id for patients in patients_by_id.values() if len(patients) == 1)
+                for start in range(0, len(found_patients), BATCH_QUERY_SIZE):
+                    for case in Case.objects.filter(patient_id__in=found_patients[start:start + BATCH_QUERY_SIZE],
+                                                    project__name='AAUH Project'):
+                        cases_by_key.setdefault((case.patient_id, case.diagnosis_date), []).append(case)
+
+                files_by_key = {}
+                found_cases = sorted(cases[0].id for cases in cases_by_key.values() if len(cases) == 1)
+                # The names are matched here, a case has few files and the names would overflow the query parameters
+                file_names = {row[0] for row in rows}
+                for start in range(0, len(found_cases), BATCH_QUERY_SIZE):
+                    for file_obj in File.objects.filter(case_id__in=found_cases[start:start + BATCH_QUERY_SIZE]):
+                        if file_obj.name in file_names:
+                            files_by_key.setdefault((file_obj.case_id, file_obj.name), []).append(file_obj)
+
+                # uploader = User.objects.get(username='charles')
+                uploader = User.objects.get(username=request.user)
+                ################## lab_info_id = request.POST['labinfo']
+                lab_info_id = 1
+                lab_info = LabInfo.objects.get(pk=lab_info_id)
+                file_format = "vcf"
+                file_type = "wes"
+
+                # Second pass: upload the files of the rows whose patient and case were found
+                for file_name, cpr_or_id, date_str, diagnosis_date, patient_id in rows:
+                    patients = patients_by_id.get(patient_id, [])
                     if len(patients) == 0:
                         # Could not find the patient
                         report.append(
@@ -398,12 +551,9 @@ class BatchUploadApiEndpoint(View):
                                                                                                               "file " + file_name + " was not uploaded to the PCM DB."
                             ))
                         continue
-                    patient = patients.first()
-                    # INFO / WARNING : Hard coding the project to 'AAUH Project'
-                    # TO-DO: Make a solution which does not crash if the project is changed.
+                    patient = patients[0]
 
-                    cases = Case.objects.filter(patient=patient, diagnosis_date=diag_datetime_obj,
-                                                project__name='AAUH Project')
+                    cases = cases_by_key.get((patient.id, diagnosis_date), [])
                     if len(cases) == 0:
                         # Could not find the case
                         report.append(
@@ -422,55 +572,60 @@ class BatchUploadApiEndpoint(View):
                                                                                                                          "The file " + file_name + " was not uploaded to the PCM DB."
                             ))
                         continue
-                    case = cases.first()
+                    case = cases[0]
 
-
-                    # uploader = User.objects.get(username='charles')
-                    uploader = User.objects.get(username=request.user)                    
-                    ################## lab_info_id = request.POST['labinfo']
-                    lab_info_id = 1
-                    lab_info = LabInfo.objects.get(pk=lab_info_id)
-                    file_format = "vcf"
-                    file_type = "wes"
                     uploaded_dt = timezone.now()
 
+                    file = None
+                    upload = uploads.get(file_name)
                     if file_name in request.FILES:
                         file = request.FILES[file_name]
                     else:
                         for name, f in request.FILES.items():
                             if f.name == file_name:
                                 file = f
-                    if file is None:
+                    if file is None and upload is None:
                         report.append((files_to_indices[file_name],
                                        "The file {} was not uploaded (correctly). Please check the file name.".format(file_name)))
                         continue
-                    size = file.size
-                    name = file.name
+                    size = file.size if file is not None else upload.size
+                    name = file.name if file is not None else upload.name
+                    # The checksum of the chunked uploads was verified on finalize
+                    sha256 = uploaded_file_sha256(file) if file is not None else upload.sha256
                     try:
-                        file_objs = File.objects.filter(case=case, name=name)
+                        file_objs = files_by_key.get((case.id, name), [])
 
                         if len(file_objs) > 1:
                             raise ValueError("Multiple files with same case and file name!")
 
+                        if len(file_objs) == 1 and file_objs[0].sha256 == sha256:
+                            # Same file uploaded again, its variants are already there
+                            File.objects.filter(pk=file_objs[0].pk).update(
+                                uploader=uploader, lab_info=lab_info, uploaded_dt=uploaded_dt)
+                            if file is None:
+                                consume_duplicate_upload(upload, file_objs[0])
+                            continue
+
                         if len(file_objs) == 1:
-                            old_obj = file_objs.first()
-                            old_file_path = os.path.join(settings.MEDIA_ROOT, old_obj.file.__str__())
-                            os.remove(old_file_path)
-                            Variant.objects.filter(file=old_obj).delete()
-                            old_obj.delete()
-
-                        obj = File.objects.create(
-                            case=case,
-                            name=name,
-                            file=file,
-                            uploader=uploader,
-                            lab_info=lab_info,
-                            format=file_format,
-                            type=file_type,
-                            uploaded_dt=uploaded_dt,
-                            size=size)
-
-                        save_variants(obj)
+                            purge_files([file_objs[0].pk])
+
+                        if file is None:
+                            obj = create_file_from_upload(upload, case, lab_info, file_format, file_type)
+                        else:
+                            obj = File.objects.create(
+                                case=case,
+                                name=name,
+                                file=file,
+                                uploader=uploader,
+                                lab_info=lab_info,
+                                format=file_format,
+                                type=file_type,
+                                uploaded_dt=uploaded_dt,
+                                size=size,
+                                sha256=sha256)
+                        files_by_key[(case.id, name)] = [obj]
+
+                        ingest_file(obj)
 
                     except IntegrityError as error:
                         report.append(
@@ -489,6 +644,14 @@ class BatchUploadApiEndpoint(View):
                 raise e
                 #return HttpResponseBadRequest("Malformed upload")
 
+    @staticmethod
+    def _get_complete_uploads(request):
+        """Return the complete chunked uploads of the user given in the 'uploads' field ({file name: upload id})."""
+        upload_ids = json.loads(request.POST.get('uploads', '{}'))
+        uploads = {upload.token: upload for upload in ChunkedUpload.objects.filter(
+            token__in=list(upload_ids.values()), uploader=request.user, status='complete')}
+        return {name: uploads[upload_id] for name, upload_id in upload_ids.items() if upload_id in uploads}
+
     # Copied from the aauh module
     @staticmethod
     def _correct_cpr_format(cpr):
@@ -521,3 +684,97 @@ class BatchUploadApiEndpoint(View):
             return False
         return True
 
+
+def get_own_upload(request, upload_id):
+    upload = ChunkedUpload.objects.filter(token=upload_id, uploader=request.user).first()
+    if upload is None:
+        raise Http404('Unknown upload')
+    return upload
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ChunkedUploadEndpoint(LoginRequiredMixin, View):
+    """Start a chunked upload, see chunked_upload for the protocol."""
+
+    def post(self, request):
+        try:
+            file_fields = {}
+            if 'case_id' in request.POST:
+                file_fields['case'] = get_accessible_case(request, request.POST['case_id'])
+                file_fields['lab_info'] = LabInfo.objects.get(pk=request.POST['labinfo'])
+                for field in ('format', 'type'):
+                    if field in request.POST:
+                        file_fields[field] = request.POST[field]
+            upload = start_upload(request.user, request.POST['name'], int(request.POST['size']),
+                                  request.POST['sha256'], **file_fields)
+        except (MultiValueDictKeyError, ValueError, ObjectDoesNotExist, ValidationError, ChunkedUploadError) as e:
+            return HttpResponseBadRequest('Malformed upload: ' + str(e))
+        return JsonResponse({'upload_id': upload.token, 'offset': 0, 'chunk_size': CHUNK_SIZE}, status=201)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ChunkedUploadChunkEndpoint(LoginRequiredMixin, View):
+    """Receive a chunk of an upload, or tell where to resume it."""
+
+    def get(self, request, upload_id):
+        upload = get_own_upload(request, upload_id)
+        return JsonResponse({'offset': upload.offset, 'size': upload.size, 'status': upload.status})
+
+    def put(self, request, upload_id):
+        upload = get_own_upload(request, upload_id)
+        try:
+            offset = int(request.GET.get('offset', 0))
+            # The body is read from the request stream as it is written to the file, never as a whole
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+            write_chunk(upload, offset, request, length)
+        except OffsetMismatch as e:
+            return JsonResponse({'offset': e.offset, 'error': str(e)}, status=409)
+        except (ValueError, ChunkedUploadError) as e:
+            return JsonResponse({'offset': upload.offset, 'error': str(e)}, status=400)
+        return JsonResponse({'offset': upload.offset})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ChunkedUploadFinalizeEndpoint(LoginRequiredMixin, View):
+    """Check a complete upload and ingest it if it was started for a case."""
+
+    def post(self, request, upload_id):
+        upload = get_own_upload(request, upload_id)
+        try:
+            complete_upload(upload)
+            if upload.status == 'complete' and upload.case_id is not None:
+                ingest_upload(upload)
+        except ChunkedUploadError as e:
+            return JsonResponse({'offset': upload.offset, 'error': str(e)}, status=400)
+
+        response = {'upload_id': upload.token, 'status': upload.status}
+        if upload.file_id is not None:
+            response['file_id'] = upload.file_id
+            response['url'] = reverse('file', kwargs={'file_id': upload.file_id})
+        return JsonResponse(response)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class VariantClassificationEndpoint(LoginRequiredMixin, View):
+    """Classify variants in bulk, see genomic.classification.
+
+    The body is a JSON object {"classifications": [{"rule": {...}, "significance": ..., "checked": ...,
+    "comment": ...}, ...]}, applied in one transaction.
+    """
+
+    def post(self, request):
+        if not request.user.has_perm('genomic.change_variant'):
+            raise PermissionDenied('The user cannot classify variants')
+        try:
+            classifications = json.loads(request.body.decode('utf-8'))['classifications']
+            report = []
+            with transaction.atomic():
+                for classification in classifications:
+                    batch, count = classify_variants(
+                        request.user, classification['rule'], classification.get('significance'),
+                        classification.get('checked'), classification.get('comment', '')
+                    )
+                    report.append({'batch': batch.id, 'updated': count})
+        except (ValueError, KeyError, TypeError) as e:
+            return HttpResponseBadRequest('Malformed classification: ' + str(e))
+        return JsonResponse(report, safe=False)